@@ -1,17 +1,24 @@
 #! /usr/bin/env python3
+import argparse
 import random
 import datetime
+from decimal import Decimal
+from functools import partial
 
-from telegram import InputMediaPhoto
+from telegram import Bot, InputMediaPhoto
+from telegram.error import BadRequest, Unauthorized
 from telegram.ext import CallbackQueryHandler, CommandHandler, \
     ConversationHandler, Filters, MessageHandler, Updater, BaseFilter
 
 from src.admin import *
 from src.enums import *
 from src.messages import create_confirmation_text, create_product_description, \
-    create_service_notice
+    create_service_notice, create_catalog_description
 from src.helpers import session_client, get_user_session, \
-    get_user_id, get_username
+    save_user_session, user_sessions, \
+    get_user_id, get_username, invalidation_listener, catalog, \
+    get_image_file_id, set_image_file_id, set_cached_member_status, \
+    set_user_locale, get_user_locale, compact_sessions
 from src.keyboards import create_drop_responsibility_keyboard, \
     create_service_notice_keyboard, create_main_keyboard, \
     create_pickup_location_keyboard, create_product_keyboard, \
@@ -21,10 +28,27 @@ from src.keyboards import create_drop_responsibility_keyboard, \
     create_bot_settings_keyboard, create_bot_couriers_keyboard, \
     create_bot_channels_keyboard, create_bot_order_options_keyboard, \
     create_back_button, create_on_off_buttons, create_ban_list_keyboard, create_service_channel_keyboard, \
-    create_bot_locations_keyboard, create_locations_keyboard
-
-from src.models import create_tables, User, Courier, Order, OrderItem, \
-    Product, ProductCount
+    create_bot_locations_keyboard, create_locations_keyboard, \
+    create_catalog_keyboard, create_bot_language_keyboard
+
+from src.dispatch import courier_index, claim_order, release_order, \
+    get_offers, add_offer, clear_offers, mark_order_offered, save_offer, \
+    get_saved_offer, is_open_order, resolve_chat_id
+from src.locales import _, translator
+from src.notifications import card_editor, notifications
+from src.orders import order_events, create_order, transition_order, \
+    get_stale_orders, touch_order
+from src.scheduler import schedule_exclusive
+from src.throttle import SendScheduler, ThrottledRequest
+from src.statistics import get_total_stats, get_courier_stats, \
+    get_location_stats, get_user_stats, get_yearly_stats, \
+    get_monthly_stats, add_order_to_daily_sales, rebuild_daily_sales
+from src.server import ThreadSafeConversationHandler, install_update_pool, \
+    start_updater
+from src.images import image_store
+from src.migrations import create_tables, migrate_keyspace
+from src.models import User, Courier, Order, OrderItem, \
+    Product, ProductCount, OrderStatus, connection, db, init_database
 
 
 # logging.basicConfig(stream=sys.stderr, format='%(asctime)s %(message)s',
@@ -42,7 +66,8 @@ from src.models import create_tables, User, Courier, Order, OrderItem, \
 # # else:
 # #     config = ConfigHelper()
 
-_ = gettext.gettext
+# products per catalog message page, also the album size limit of telegram
+CATALOG_PAGE_SIZE = 10
 
 #
 # bot helper functions
@@ -56,11 +81,7 @@ def is_vip_customer(bot, user_id):
     chat_id = config.get_vip_customers_channel()
 
     try:
-        member = bot.getChatMember(chat_id, user_id)
-        if member.status == 'left':
-            return False
-        else:
-            return True
+        return is_chat_member(bot, chat_id, user_id)
     except TelegramError as e:
         logger.error("Failed to check vip customer id: %s", e)
         return False
@@ -73,11 +94,7 @@ def is_customer(bot, user_id):
     chat_id = config.get_customers_channel()
 
     try:
-        member = bot.getChatMember(chat_id, user_id)
-        if member.status == 'left':
-            return False
-        else:
-            return True
+        return is_chat_member(bot, chat_id, user_id)
     except TelegramError as e:
         logger.error("Failed to check customer id: %s", e)
         return False
@@ -86,6 +103,82 @@ def is_customer(bot, user_id):
 # we assume people in service channel can administrate the bot
 
 
+def send_product_photo(bot, chat_id, product):
+    # image bytes are uploaded once, later sends reuse telegram's file_id
+    if not product.image_hash:
+        return None
+    file_id = get_image_file_id(bot, product.image_hash)
+    if file_id:
+        try:
+            return bot.send_photo(chat_id, photo=file_id)
+        except BadRequest as e:
+            logger.info('Cached photo of product %s rejected: %s',
+                        product.id, e)
+
+    with image_store.open(product.image_hash) as image:
+        message = bot.send_photo(chat_id, photo=image)
+    set_image_file_id(bot, product.image_hash, message.photo[-1].file_id)
+    return message
+
+
+def send_catalog_photos(bot, chat_id, products):
+    # albums can only reference photos already uploaded to telegram,
+    # products without a cached file_id are uploaded one by one first
+    media = []
+    for product in products:
+        if not product.image_hash:
+            continue
+        file_id = get_image_file_id(bot, product.image_hash)
+        if file_id:
+            media.append(
+                (product, InputMediaPhoto(file_id, caption=product.title)))
+        else:
+            send_product_photo(bot, chat_id, product)
+
+    for i in range(0, len(media), CATALOG_PAGE_SIZE):
+        chunk = media[i:i + CATALOG_PAGE_SIZE]
+        if len(chunk) > 1:
+            try:
+                bot.send_media_group(chat_id,
+                                     media=[item for product, item in chunk])
+                continue
+            except BadRequest as e:
+                logger.info('Catalog album rejected: %s', e)
+        for product, item in chunk:
+            send_product_photo(bot, chat_id, product)
+
+
+def create_catalog_page(user_data, page):
+    products = catalog.get_active()
+    pages = max(1, -(-len(products) // CATALOG_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    page_products = products[page * CATALOG_PAGE_SIZE:
+                             (page + 1) * CATALOG_PAGE_SIZE]
+    products_info = []
+    for product in page_products:
+        products_info.append((
+            product.title, product.tiers,
+            cart.get_product_count(user_data, product.id),
+            cart.get_product_subtotal(user_data, product.id)))
+    text = create_catalog_description(
+        products_info, config.get_delivery_min(), config.get_delivery_fee(),
+        page, pages)
+    reply_markup = create_catalog_keyboard(
+        page_products, page, pages, user_data, cart)
+    return text, reply_markup
+
+
+def create_product_card(user_data, product_id):
+    product_title, prices = cart.product_full_info(user_data, product_id)
+    text = create_product_description(
+        product_title, prices,
+        cart.get_product_count(user_data, product_id),
+        cart.get_product_subtotal(user_data, product_id),
+        config.get_delivery_min(), config.get_delivery_fee())
+    reply_markup = create_product_keyboard(product_id, user_data, cart)
+    return text, reply_markup
+
+
 def create_photo_question():
     q1 = _('👍')
     q2 = _('🤘')
@@ -98,23 +191,55 @@ def resend_responsibility_keyboard(bot, update, user_data):
     query = update.callback_query
     data = query.data
     label, order_id = data.split('|')
-    user_id = get_user_id(update)
-    session = get_user_session(user_id)
+    courier = courier_index.get(get_user_id(update))
     try:
         order = Order.get(id=order_id)
     except Order.DoesNotExist:
         logger.info('Order № {} not found!'.format(order_id))
-    else:
-        order.courier = None
-        order.save()
-    bot.delete_message(config.get_couriers_channel(),
+        return
+    # only the courier holding the order can drop it
+    if courier is None or order.courier_id != courier.id:
+        bot.answer_callback_query(
+            query.id, text=_('This order is not assigned to you'))
+        return
+    if not release_order(order.id, courier.id):
+        bot.answer_callback_query(
+            query.id,
+            text=_('Order №{} is already confirmed').format(order_id))
+        return
+    bot.delete_message(query.message.chat_id,
                        message_id=query.message.message_id)
-    bot.send_message(config.get_couriers_channel(),
-                     text=query.message.text,
-                     parse_mode=ParseMode.HTML,
-                     reply_markup=create_service_notice_keyboard(
-                         update, user_id, order_id),
-                     )
+    clear_offers(order.id)
+    # the first offer as it was rendered for the couriers, not the text of
+    # this courier's copy
+    offer = get_saved_offer(order.id)
+    if offer is not None:
+        offer_order(bot, order.id, offer['user_id'], offer['location_id'],
+                    offer['text'], parse_mode=offer['parse_mode'])
+    else:
+        offer_order(bot, order.id, order.user.telegram_id, order.location_id,
+                    query.message.text)
+
+
+def on_order_delivered(bot, update, user_data):
+    query = update.callback_query
+    label, order_id = query.data.split('|')
+    courier = courier_index.get(get_user_id(update))
+    if courier is None:
+        bot.answer_callback_query(
+            query.id, text=_('This order is not assigned to you'))
+        return
+    if not transition_order(int(order_id), OrderStatus.DELIVERED,
+                            Order.courier == courier.id):
+        bot.answer_callback_query(
+            query.id,
+            text=_('Order №{} is not confirmed yet').format(order_id))
+        return
+    bot.edit_message_reply_markup(chat_id=query.message.chat_id,
+                                  message_id=query.message.message_id,
+                                  reply_markup=None)
+    bot.answer_callback_query(
+        query.id, text=_('Order №{} delivered').format(order_id))
 
 
 def make_confirm(bot, update, user_data):
@@ -128,15 +253,21 @@ def make_confirm(bot, update, user_data):
     except Order.DoesNotExist:
         logger.info('Order № {} not found!'.format(order_id))
     else:
-        order.confirmed = True
-        order.save()
-
-        user_id = order.user.telegram_id
-        bot.send_message(
-            user_id,
-            text=_('Courier @{} assigned for order № {}').format(courier_name, order_id),
-            parse_mode=ParseMode.HTML,
-        )
+        with db.atomic():
+            # only the first confirmation of an order is counted
+            confirmed = transition_order(order.id, OrderStatus.CONFIRMED)
+            if confirmed:
+                add_order_to_daily_sales(order)
+        if not confirmed:
+            # confirmed before or cancelled by the sweep meanwhile
+            return
+
+        user = order.user
+        with translator.using(user.locale):
+            text = _('Courier @{} assigned for order № {}').format(
+                courier_name, order_id)
+        bot.send_message(user.telegram_id, text=text,
+                         parse_mode=ParseMode.HTML)
 
 
 def make_unconfirm(bot, update, user_data):
@@ -151,12 +282,11 @@ def make_unconfirm(bot, update, user_data):
         logger.info('Order № {} not found!'.format(order_id))
     else:
         user_id = order.user.telegram_id
-        bot.send_message(config.get_couriers_channel(),
-                         text='The admin did not confirm. Please retake '
-                              'responsibility for order №{}'.format(order_id),
-                         reply_markup=create_service_notice_keyboard(
-                             update, user_id, order_id),
-                         )
+        release_order(order.id)
+        clear_offers(order.id)
+        offer_order(bot, order.id, user_id, order.location_id,
+                    lambda: _('The admin did not confirm. Please retake '
+                              'responsibility for order №{}').format(order_id))
 
 #
 # bot handlers
@@ -169,8 +299,17 @@ def on_start(bot, update, user_data):
     try:
         user = User.get(telegram_id=user_id)
     except User.DoesNotExist:
-        user = User(telegram_id=user_id, username=username)
+        locale = update.message.from_user.language_code
+        if locale:
+            locale = locale.split('-')[0]
+        if locale not in translator.locales:
+            locale = None
+        user = User(telegram_id=user_id, username=username, locale=locale)
         user.save()
+        if locale is not None:
+            # the session was made before the user existed
+            set_user_locale(user_id, locale)
+            translator.set_locale(locale)
     BOT_ON = config.get_bot_on_off() and username not in config.get_banned_users()
     if BOT_ON or is_admin(bot, user_id):
         if is_customer(bot, user_id) or is_vip_customer(bot, user_id):
@@ -232,28 +371,31 @@ def on_menu(bot, update, user_data=None):
                                       parse_mode=ParseMode.MARKDOWN, )
 
                 # send_products to current chat
-                for product in Product.filter(is_active=True):
-                    product_count = cart.get_product_count(
-                        user_data, product.id)
-                    subtotal = cart.get_product_subtotal(
-                        user_data, product.id)
-                    delivery_fee = config.get_delivery_fee()
-                    delivery_min = config.get_delivery_min()
-                    product_title, prices = cart.product_full_info(
-                        user_data, product.id)
-                    image_data = product.image
-                    image_stream = io.BytesIO(image_data)
-                    bot.send_photo(query.message.chat_id,
-                                   photo=image_stream)
-                    bot.send_message(query.message.chat_id,
-                                     text=create_product_description(
-                                         product_title, prices,
-                                         product_count, subtotal,
-                                         delivery_min, delivery_fee),
-                                     reply_markup=create_product_keyboard(
-                                         product.id, user_data, cart),
-                                     parse_mode=ParseMode.HTML,
-                                     timeout=20, )
+                if config.get_catalog_mode() == 'list':
+                    send_catalog_photos(bot, query.message.chat_id,
+                                        catalog.get_active())
+                    text, reply_markup = create_catalog_page(user_data, 0)
+                    message = bot.send_message(query.message.chat_id,
+                                               text=text,
+                                               reply_markup=reply_markup,
+                                               parse_mode=ParseMode.HTML,
+                                               timeout=20, )
+                    card_editor.remember(message.chat_id, message.message_id,
+                                         text, reply_markup)
+                else:
+                    for product in catalog.get_active():
+                        text, reply_markup = create_product_card(
+                            user_data, product.id)
+                        send_product_photo(bot, query.message.chat_id,
+                                           product)
+                        message = bot.send_message(query.message.chat_id,
+                                                   text=text,
+                                                   reply_markup=reply_markup,
+                                                   parse_mode=ParseMode.HTML,
+                                                   timeout=20, )
+                        card_editor.remember(
+                            message.chat_id, message.message_id, text,
+                            reply_markup)
 
                 # send menu again as a new message
                 bot.send_message(query.message.chat_id,
@@ -295,47 +437,55 @@ def on_menu(bot, update, user_data=None):
                                           config.get_reviews_channel(),
                                           is_admin(bot, user_id), total),
                                       parse_mode=ParseMode.MARKDOWN, )
-            elif data.startswith('product_add'):
-                product_id = int(data.split('|')[1])
-                user_data = cart.add(user_data, product_id)
-                session_client.json_set(user_id, user_data)
-
-                subtotal = cart.get_product_subtotal(user_data, product_id)
-                delivery_fee = config.get_delivery_fee()
-                delivery_min = config.get_delivery_min()
-                product_title, prices = cart.product_full_info(
-                    user_data, product_id)
-                product_count = cart.get_product_count(user_data, product_id)
-
-                bot.edit_message_text(chat_id=query.message.chat_id,
-                                      message_id=query.message.message_id,
-                                      text=create_product_description(
-                                          product_title, prices,
-                                          product_count, subtotal,
-                                          delivery_min, delivery_fee),
-                                      reply_markup=create_product_keyboard(
-                                          product_id, user_data, cart),
-                                      parse_mode=ParseMode.HTML, )
-            elif data.startswith('product_remove'):
-                product_id = int(data.split('|')[1])
-                user_data = cart.remove(user_data, product_id)
-                session_client.json_set(user_id, user_data)
-
-                subtotal = cart.get_product_subtotal(user_data, product_id)
-                delivery_fee = config.get_delivery_fee()
-                delivery_min = config.get_delivery_min()
-                product_title, prices = cart.product_full_info(
-                    user_data, product_id)
-                product_count = cart.get_product_count(user_data, product_id)
+            elif data.startswith(('product_add', 'product_remove')):
+                label, product_id = data.split('|')[:2]
+                product_id = int(product_id)
+                # the cart changes right away, the card catches up once the
+                # clicks stop
+                if label == 'product_add':
+                    user_data = cart.add(user_data, product_id)
+                else:
+                    user_data = cart.remove(user_data, product_id)
+                save_user_session(user_id, user_data)
 
+                text, reply_markup = create_product_card(user_data, product_id)
+                card_editor.edit(bot, query.message.chat_id,
+                                 query.message.message_id,
+                                 text, reply_markup,
+                                 parse_mode=ParseMode.HTML, )
+            elif data.startswith('catalog'):
+                # list mode catalog, only the catalog message is edited
+                label, *args = data.split('|')
+                if label == 'catalog_add':
+                    user_data = cart.add(user_data, int(args[0]))
+                    save_user_session(user_id, user_data)
+                elif label == 'catalog_remove':
+                    user_data = cart.remove(user_data, int(args[0]))
+                    save_user_session(user_id, user_data)
+                page = int(args[-1])
+
+                text, reply_markup = create_catalog_page(user_data, page)
+                card_editor.edit(bot, query.message.chat_id,
+                                 query.message.message_id,
+                                 text, reply_markup,
+                                 parse_mode=ParseMode.HTML, )
+            elif data == 'menu_language':
+                bot.edit_message_text(
+                    chat_id=query.message.chat_id,
+                    message_id=query.message.message_id,
+                    text=_('🌐 Language'),
+                    reply_markup=create_bot_language_keyboard('menu_lng_'))
+            elif data.startswith('menu_lng_'):
+                locale = data[len('menu_lng_'):]
+                if locale in translator.locales:
+                    set_user_locale(user_id, locale)
+                    translator.set_locale(locale)
                 bot.edit_message_text(chat_id=query.message.chat_id,
                                       message_id=query.message.message_id,
-                                      text=create_product_description(
-                                          product_title, prices,
-                                          product_count, subtotal,
-                                          delivery_min, delivery_fee),
-                                      reply_markup=create_product_keyboard(
-                                          product_id, user_data, cart),
+                                      text=config.get_order_text(),
+                                      reply_markup=create_main_keyboard(
+                                          config.get_reviews_channel(),
+                                          is_admin(bot, user_id), total),
                                       parse_mode=ParseMode.HTML, )
             elif data == 'menu_settings':
                 bot.edit_message_text(chat_id=query.message.chat_id,
@@ -441,7 +591,7 @@ def enter_state_identify_photo(bot, update, user_data):
     else:
         session['shipping']['photo_question'] = {}
         session['shipping']['photo_question'] = create_photo_question()
-    session_client.json_set(user_id, session)
+    save_user_session(user_id, session)
     text = _('Please provide an identification picture. {}').format(
         session['shipping']['photo_question'])
     update.message.reply_text(text=text, reply_markup=create_cancel_keyboard(),
@@ -467,7 +617,8 @@ def enter_state_order_confirm(bot, update, user_data):
     product_info = cart.get_products_info(user_data)
     update.message.reply_text(
         text=create_confirmation_text(
-            is_pickup, shipping_data, total, delivery_cost, delivery_min, product_info),
+            is_pickup, shipping_data, total, delivery_min, delivery_cost,
+            product_info),
         reply_markup=create_confirmation_keyboard(),
         parse_mode=ParseMode.HTML,
     )
@@ -499,7 +650,7 @@ def enter_state_init_order_cancelled(bot, update, user_data):
     total = cart.get_cart_total(get_user_session(user_id))
     user_data['cart'] = {}
     user_data['shipping'] = {}
-    session_client.json_set(user_id, user_data)
+    save_user_session(user_id, user_data)
     update.message.reply_text(text=_('<b>Order cancelled</b>'),
                               reply_markup=ReplyKeyboardRemove(),
                               parse_mode=ParseMode.HTML, )
@@ -522,11 +673,15 @@ def on_shipping_method(bot, update, user_data):
     key = update.message.text
     user_id = get_user_id(update)
     user_data = get_user_session(user_id)
-    if key == BUTTON_TEXT_CANCEL:
+    if key == _(BUTTON_TEXT_CANCEL):
         return enter_state_init_order_cancelled(bot, update, user_data)
-    elif key == BUTTON_TEXT_PICKUP or key == BUTTON_TEXT_DELIVERY:
-        user_data['shipping']['method'] = key
-        session_client.json_set(user_id, user_data)
+    elif key == _(BUTTON_TEXT_PICKUP) or key == _(BUTTON_TEXT_DELIVERY):
+        # kept untranslated, the language may change before checkout is done
+        if key == _(BUTTON_TEXT_PICKUP):
+            user_data['shipping']['method'] = BUTTON_TEXT_PICKUP
+        else:
+            user_data['shipping']['method'] = BUTTON_TEXT_DELIVERY
+        save_user_session(user_id, user_data)
         return enter_state_courier_location(bot, update, user_data)
     else:
         return enter_state_shipping_method(bot, update, user_data)
@@ -536,13 +691,13 @@ def on_shipping_method(bot, update, user_data):
 def on_bot_language_change(bot, update, user_data):
     query = update.callback_query
     data = query.data
-    # user_id = get_user_id(update)
-    # user_data = get_user_session(user_id)
-    global _
-    if data == 'lng_en':
-        _ = gettext.gettext
-    elif data == 'lng_he':
-        _ = cat.gettext
+    user_id = get_user_id(update)
+    locale = data.split('_', 1)[1]
+    if locale in translator.locales:
+        # only this user switches, the rest of this update is answered in
+        # the new language too
+        set_user_locale(user_id, locale)
+        translator.set_locale(locale)
     bot.edit_message_text(chat_id=query.message.chat_id,
                           message_id=query.message.message_id,
                           text=_('⚙ Bot settings'),
@@ -550,7 +705,8 @@ def on_bot_language_change(bot, update, user_data):
                           parse_mode=ParseMode.MARKDOWN)
     query.answer()
     return ADMIN_BOT_SETTINGS
-    
+
+
 def on_shipping_pickup_location(bot, update, user_data):
     key = update.message.text
     user_id = get_user_id(update)
@@ -558,13 +714,13 @@ def on_shipping_pickup_location(bot, update, user_data):
     locations = Location.select()
     location_names = [x.title for x in locations]
 
-    if key == BUTTON_TEXT_BACK:
+    if key == _(BUTTON_TEXT_BACK):
         return enter_state_shipping_method(bot, update, user_data)
-    elif key == BUTTON_TEXT_CANCEL:
+    elif key == _(BUTTON_TEXT_CANCEL):
         return enter_state_init_order_cancelled(bot, update, user_data)
     elif any(key in s for s in location_names):
         user_data['shipping']['pickup_location'] = key
-        session_client.json_set(user_id, user_data)
+        save_user_session(user_id, user_data)
 
         if user_data['shipping']['method'] == BUTTON_TEXT_DELIVERY:
             return enter_state_location_delivery(bot, update, user_data)
@@ -582,18 +738,18 @@ def on_shipping_delivery_address(bot, update, user_data):
     if update.message.location:
         location = update.message.location
         user_data['shipping']['location'] = location
-        session_client.json_set(user_id, user_data)
+        save_user_session(user_id, user_data)
 
         return enter_state_shipping_time(bot, update, user_data)
     else:
-        if key == BUTTON_TEXT_BACK:
+        if key == _(BUTTON_TEXT_BACK):
             return enter_state_shipping_method(bot, update, user_data)
-        elif key == BUTTON_TEXT_CANCEL:
+        elif key == _(BUTTON_TEXT_CANCEL):
             return enter_state_init_order_cancelled(bot, update, user_data)
         else:
             address = update.message.text
             user_data['shipping']['address'] = address
-            session_client.json_set(user_id, user_data)
+            save_user_session(user_id, user_data)
 
             return enter_state_shipping_time(bot, update, user_data)
 
@@ -602,13 +758,13 @@ def on_checkout_time(bot, update, user_data):
     key = update.message.text
     user_id = get_user_id(update)
     user_data = get_user_session(user_id)
-    if key == BUTTON_TEXT_BACK:
+    if key == _(BUTTON_TEXT_BACK):
         return enter_state_shipping_method(bot, update, user_data)
-    elif key == BUTTON_TEXT_CANCEL:
+    elif key == _(BUTTON_TEXT_CANCEL):
         return enter_state_init_order_cancelled(bot, update, user_data)
-    elif key == BUTTON_TEXT_NOW:
-        user_data['shipping']['time'] = key
-        session_client.json_set(user_id, user_data)
+    elif key == _(BUTTON_TEXT_NOW):
+        user_data['shipping']['time'] = BUTTON_TEXT_NOW
+        save_user_session(user_id, user_data)
 
         if config.get_phone_number_required():
             return enter_state_phone_number_text(bot, update, user_data)
@@ -617,9 +773,9 @@ def on_checkout_time(bot, update, user_data):
                 return enter_state_identify_photo(bot, update, user_data)
             else:
                 return enter_state_order_confirm(bot, update, user_data)
-    elif key == BUTTON_TEXT_SETTIME:
-        user_data['shipping']['time'] = key
-        session_client.json_set(user_id, user_data)
+    elif key == _(BUTTON_TEXT_SETTIME):
+        user_data['shipping']['time'] = BUTTON_TEXT_SETTIME
+        save_user_session(user_id, user_data)
 
         return enter_state_shipping_time_text(bot, update, user_data)
     else:
@@ -632,13 +788,13 @@ def on_shipping_time_text(bot, update, user_data):
     user_id = get_user_id(update)
     user_data = get_user_session(user_id)
 
-    if key == BUTTON_TEXT_BACK:
+    if key == _(BUTTON_TEXT_BACK):
         return enter_state_shipping_time(bot, update, user_data)
-    elif key == BUTTON_TEXT_CANCEL:
+    elif key == _(BUTTON_TEXT_CANCEL):
         return enter_state_init_order_cancelled(bot, update, user_data)
     else:
         user_data['shipping']['time_text'] = key
-        session_client.json_set(user_id, user_data)
+        save_user_session(user_id, user_data)
 
         return enter_state_phone_number_text(bot, update, user_data)
 
@@ -648,19 +804,19 @@ def on_phone_number_text(bot, update):
     user_id = get_user_id(update)
     user_data = get_user_session(user_id)
 
-    if key == BUTTON_TEXT_CANCEL:
+    if key == _(BUTTON_TEXT_CANCEL):
         return enter_state_init_order_cancelled(bot, update, user_data)
-    elif key == BUTTON_TEXT_BACK:
+    elif key == _(BUTTON_TEXT_BACK):
         return enter_state_shipping_time(bot, update, user_data)
     else:
         phone_number_text = update.message.contact.phone_number
         user_data['shipping']['phone_number'] = phone_number_text
-        session_client.json_set(user_id, user_data)
+        save_user_session(user_id, user_data)
 
         if is_vip_customer(bot, user_id):
             vip = _('vip costumer')
             user_data['shipping']['vip'] = vip
-            session_client.json_set(user_id, user_data)
+            save_user_session(user_id, user_data)
 
             return enter_state_order_confirm(bot, update, user_data)
         elif config.get_identification_required():
@@ -674,9 +830,9 @@ def on_shipping_identify_photo(bot, update, user_data):
     user_id = get_user_id(update)
     user_data = get_user_session(user_id)
 
-    if key == BUTTON_TEXT_CANCEL:
+    if key == _(BUTTON_TEXT_CANCEL):
         return enter_state_init_order_cancelled(bot, update, user_data)
-    elif key == BUTTON_TEXT_BACK:
+    elif key == _(BUTTON_TEXT_BACK):
         if config.get_phone_number_required():
             return enter_state_phone_number_text(bot, update, user_data)
         else:
@@ -684,7 +840,7 @@ def on_shipping_identify_photo(bot, update, user_data):
     if update.message.photo:
         photo_file = bot.get_file(update.message.photo[-1].file_id)
         user_data['shipping']['photo_id'] = photo_file.file_id
-        session_client.json_set(user_id, user_data)
+        save_user_session(user_id, user_data)
         #
         if config.get_identification_stage2_required():
             return enter_state_identify_stage2(bot, update, user_data)
@@ -700,15 +856,15 @@ def on_shipping_identify_stage2(bot, update, user_data):
     user_id = get_user_id(update)
     user_data = get_user_session(user_id)
 
-    if key == BUTTON_TEXT_CANCEL:
+    if key == _(BUTTON_TEXT_CANCEL):
         return enter_state_init_order_cancelled(bot, update, user_data)
-    elif key == BUTTON_TEXT_BACK:
+    elif key == _(BUTTON_TEXT_BACK):
         return enter_state_identify_photo(bot, update, user_data)
 
     if update.message.photo:
         photo_file = bot.get_file(update.message.photo[-1].file_id)
         user_data['shipping']['stage2_id'] = photo_file.file_id
-        session_client.json_set(user_id, user_data)
+        save_user_session(user_id, user_data)
 
         return enter_state_order_confirm(bot, update, user_data)
     else:
@@ -725,7 +881,7 @@ def on_confirm_order(bot, update, user_data):
     username = get_username(update)
     user_data = get_user_session(user_id)
 
-    if key == BUTTON_TEXT_CONFIRM:
+    if key == _(BUTTON_TEXT_CONFIRM):
         try:
             user = User.get(telegram_id=user_id)
         except User.DoesNotExist:
@@ -738,10 +894,12 @@ def on_confirm_order(bot, update, user_data):
                 title=user_data.get('shipping', {}).get('pickup_location'))
         except Location.DoesNotExist:
             location = None
-        order = Order.create(user=user, location=location,
-                             date_created=datetime.datetime.now())
+        # the order and all its lines are written together or not at all
+        with db.atomic():
+            order = create_order(user=user, location=location,
+                                 date_created=datetime.datetime.now())
+            cart.fill_order(user_data, order)
         order_id = order.id
-        cart.fill_order(user_data, order)
         is_pickup = user_data['shipping']['method'] == BUTTON_TEXT_PICKUP
         product_info = cart.get_products_info(user_data)
         shipping_data = user_data['shipping']
@@ -762,74 +920,37 @@ def on_confirm_order(bot, update, user_data):
         #                  reply_markup=create_service_channel_keyboard(order_id, show_order, is_vip)
         #                  )
 
-        # ORDER CONFIRMED, send the details to service channel
-        txt = _('Order confirmed from (@{})\n\n').format(update.message.from_user.username)
-        bot.send_message(config.get_service_channel(),
-                         text=txt + create_service_notice(
-                             is_pickup, order_id, product_info, shipping_data,
-                             total, delivery_min, delivery_cost),
-                         parse_mode=ParseMode.HTML,
-                         )
-
-        if 'photo_id' in user_data['shipping']:
-            bot.send_photo(config.get_service_channel(),
-                           photo=user_data['shipping']['photo_id'],
-                           caption=_('Stage 1 Identification - Selfie'),
-                           parse_mode=ParseMode.MARKDOWN, )
-
-        if 'stage2_id' in user_data['shipping']:
-            bot.send_photo(
-                config.get_service_channel(),
-                photo=user_data['shipping']['stage2_id'],
-                caption=_('Stage 2 Identification - FB'),
-                parse_mode=ParseMode.MARKDOWN, )
-
-        if 'location' in user_data['shipping']:
-            bot.send_location(
-                config.get_service_channel(),
-                location=user_data['shipping']['location']
-            )
-
-        if config.get_has_courier_option():
-            bot.send_message(config.get_couriers_channel(),
-                             text=_('Order confirmed from (@{})').format(
-                                 update.message.from_user.username),
-                             parse_mode=ParseMode.MARKDOWN, )
-            bot.send_message(config.get_couriers_channel(),
-                             text=create_service_notice(
-                                 is_pickup, order_id, product_info,
-                                 shipping_data, total, delivery_min, delivery_cost),
-                             parse_mode=ParseMode.HTML,
-                             reply_markup=create_service_notice_keyboard(
-                                 update, user_id, order_id),
-                             )
-            if 'photo_id' in user_data['shipping']:
-                bot.send_photo(config.get_couriers_channel(),
-                               photo=user_data['shipping']['photo_id'],
-                               caption=_('Stage 1 Identification - Selfie'),
-                               parse_mode=ParseMode.MARKDOWN, )
-
-            if 'location' in user_data['shipping']:
-                bot.send_location(
-                    config.get_couriers_channel(),
-                    location=user_data['shipping']['location']
-                )
-
         # clear cart and shipping data
         user_data['cart'] = {}
         user_data['shipping'] = {}
-        session_client.json_set(user_id, user_data)
+        save_user_session(user_id, user_data)
+
+        # channel posts are made by the order events consumer, the customer
+        # doesn't wait for them
+        order_events.publish({
+            'order_id': order_id,
+            'user_id': user_id,
+            'username': update.message.from_user.username,
+            'is_pickup': is_pickup,
+            'product_info': [(title, count, str(price))
+                             for title, count, price in product_info],
+            'shipping_data': shipping_data,
+            'total': str(total),
+            'delivery_min': delivery_min,
+            'delivery_cost': delivery_cost,
+            'location_id': order.location_id,
+        })
 
         return enter_state_init_order_confirmed(bot, update, user_data)
 
-    elif key == BUTTON_TEXT_CANCEL:
+    elif key == _(BUTTON_TEXT_CANCEL):
         # ORDER CANCELLED, send nothing
         # and only clear shipping details
         user_data['shipping'] = {}
-        session_client.json_set(user_id, user_data)
+        save_user_session(user_id, user_data)
 
         return enter_state_init_order_cancelled(bot, update, user_data)
-    elif key == BUTTON_TEXT_BACK:
+    elif key == _(BUTTON_TEXT_BACK):
         if config.get_identification_required():
             if config.get_identification_stage2_required():
                 return enter_state_identify_stage2(bot, update, user_data)
@@ -843,6 +964,207 @@ def on_confirm_order(bot, update, user_data):
         logger.warn("Unknown input %s", key)
 
 
+def post_order_event(bot, event):
+    # runs in the order events consumer, every post is made once per order
+    # even if the event is handled again after a failure
+    order_id = event['order_id']
+    shipping_data = event['shipping_data']
+    notice = create_service_notice(
+        event['is_pickup'], order_id, event['product_info'], shipping_data,
+        Decimal(event['total']), event['delivery_min'],
+        event['delivery_cost'])
+
+    def post(step, chat_id, method, **kwargs):
+        order_events.run_once(order_id, step, getattr(bot, method),
+                              chat_id, **kwargs)
+
+    service_channel = config.get_service_channel()
+    txt = _('Order confirmed from (@{})\n\n').format(event['username'])
+    post('service_notice', service_channel, 'send_message',
+         text=txt + notice, parse_mode=ParseMode.HTML)
+
+    if 'photo_id' in shipping_data:
+        post('service_photo', service_channel, 'send_photo',
+             photo=shipping_data['photo_id'],
+             caption=_('Stage 1 Identification - Selfie'),
+             parse_mode=ParseMode.MARKDOWN, )
+
+    if 'stage2_id' in shipping_data:
+        post('service_stage2', service_channel, 'send_photo',
+             photo=shipping_data['stage2_id'],
+             caption=_('Stage 2 Identification - FB'),
+             parse_mode=ParseMode.MARKDOWN, )
+
+    if 'location' in shipping_data:
+        post('service_location', service_channel, 'send_location',
+             location=shipping_data['location'])
+
+    if not config.get_has_courier_option():
+        return
+    mark_order_offered(order_id)
+    chat_ids = get_offer_chats(event.get('location_id'))
+    couriers_channel = config.get_couriers_channel()
+    if couriers_channel in chat_ids:
+        post('couriers_header', couriers_channel, 'send_message',
+             text=_('Order confirmed from (@{})').format(event['username']),
+             parse_mode=ParseMode.MARKDOWN, )
+    offer_order(bot, order_id, event['user_id'], event.get('location_id'),
+                notice, parse_mode=ParseMode.HTML)
+    for chat_id in chat_ids:
+        if 'photo_id' in shipping_data and chat_id == couriers_channel:
+            post('couriers_photo', couriers_channel, 'send_photo',
+                 photo=shipping_data['photo_id'],
+                 caption=_('Stage 1 Identification - Selfie'),
+                 parse_mode=ParseMode.MARKDOWN, )
+
+        if 'location' in shipping_data:
+            post('couriers_location:{}'.format(chat_id), chat_id,
+                 'send_location', location=shipping_data['location'])
+
+
+def get_offer_chats(location_id):
+    # couriers serving the location get the offer in private, orders without
+    # one or nobody to serve it go to the couriers channel
+    couriers = ()
+    if location_id is not None:
+        couriers = courier_index.for_location(location_id)
+    if not couriers:
+        return [config.get_couriers_channel()]
+    return [courier.telegram_id for courier in couriers]
+
+
+def get_chat_locale(chat_id):
+    # channels and groups have negative ids and get the default locale
+    if chat_id > 0:
+        return get_user_locale(chat_id)
+    return None
+
+
+def offer_order(bot, order_id, user_id, location_id, text, parse_mode=None,
+                escalate=False):
+    # text is either final or a callable rendering it in the current locale
+    if not is_open_order(order_id):
+        # taken or closed meanwhile
+        return
+    render = text if callable(text) else lambda: text
+    with translator.using(None):
+        save_offer(order_id, user_id, location_id, render(), parse_mode)
+    offers = get_offers(order_id)
+    chat_ids = get_offer_chats(location_id)
+    couriers_channel = config.get_couriers_channel()
+    if escalate and couriers_channel not in chat_ids:
+        chat_ids.append(couriers_channel)
+    for chat_id in chat_ids:
+        try:
+            chat_id = resolve_chat_id(bot, chat_id)
+            if str(chat_id) in offers:
+                continue
+            # rendered for the courier, not for whoever caused the offer
+            with translator.using(get_chat_locale(chat_id)):
+                chat_text = render()
+                keyboard = create_service_notice_keyboard(
+                    None, user_id, order_id)
+            message = bot.send_message(
+                chat_id, text=chat_text, parse_mode=parse_mode,
+                reply_markup=keyboard)
+        except (BadRequest, Unauthorized) as e:
+            # courier never started the bot or blocked it, the others
+            # still get the offer
+            logger.warning('Offer of order %s to %s failed: %s',
+                           order_id, chat_id, e)
+            continue
+        add_offer(order_id, message.chat_id, message.message_id)
+
+
+def withdraw_offers(bot, order_id, keep_chat_id=None):
+    for chat_id, message_id in get_offers(order_id).items():
+        if chat_id != keep_chat_id:
+            notifications.send(bot, chat_id, 'delete_message',
+                               message_id=message_id)
+    clear_offers(order_id)
+
+
+def reoffer_order(bot, order_id, offer, escalate=False):
+    withdraw_offers(bot, order_id)
+    offer_order(bot, order_id, offer['user_id'], offer['location_id'],
+                offer['text'], parse_mode=offer['parse_mode'],
+                escalate=escalate)
+
+
+def expire_order(bot, order_id):
+    if not transition_order(order_id, OrderStatus.CANCELLED):
+        return
+    withdraw_offers(bot, order_id)
+    notifications.send(
+        bot, config.get_service_channel(), 'send_message',
+        text=_('Order №{} was not handled in time and is cancelled').format(
+            order_id))
+    user_id, locale = Order.select(User.telegram_id, User.locale).join(
+        User, on=Order.user).where(Order.id == order_id).scalar(as_tuple=True)
+    with translator.using(locale):
+        text = _('Sorry, your order №{} could not be handled in time and '
+                 'is cancelled').format(order_id)
+    notifications.send(bot, user_id, 'send_message', text=text)
+
+
+def sweep_orders(bot, job):
+    # orders no courier took or the admin never confirmed, the oldest first,
+    # each sweep bumps the time the next one looks at
+    with connection():
+        now = datetime.datetime.now()
+        batch_size = config.get_sweep_batch_size()
+        expire_after = datetime.timedelta(seconds=config.get_order_expiry())
+        offer_timeout = config.get_offer_timeout()
+        stale = get_stale_orders(
+            OrderStatus.OFFERED,
+            now - datetime.timedelta(seconds=offer_timeout), batch_size)
+        for order_id, entered in stale:
+            offer = get_saved_offer(order_id)
+            if not touch_order(order_id, OrderStatus.OFFERED):
+                continue
+            if entered is None or offer is None:
+                # not offered by the bot, only moved out of the way of
+                # the orders the next sweeps look at
+                continue
+            if now - entered > expire_after:
+                expire_order(bot, order_id)
+                continue
+            # from the second repeat on the couriers channel gets it too
+            level = int((now - entered).total_seconds()) // offer_timeout
+            escalate = level >= 2
+            reoffer_order(bot, order_id, offer, escalate)
+            if escalate:
+                notifications.send(
+                    bot, config.get_service_channel(), 'send_message',
+                    text=_('Order №{} is still not taken by a courier').format(
+                        order_id))
+
+        stale = get_stale_orders(
+            OrderStatus.CLAIMED,
+            now - datetime.timedelta(seconds=config.get_confirm_timeout()),
+            batch_size)
+        for order_id, entered in stale:
+            if not touch_order(order_id, OrderStatus.CLAIMED):
+                continue
+            if entered is None or get_saved_offer(order_id) is None:
+                continue
+            if now - entered > expire_after:
+                expire_order(bot, order_id)
+            else:
+                notifications.send(
+                    bot, config.get_service_channel(), 'send_message',
+                    text=_('Order №{} is waiting for the courier to be '
+                           'confirmed').format(order_id))
+
+
+def compact_idle_sessions(bot, job):
+    with connection():
+        compacted = compact_sessions(config.get_cart_ttl(),
+                                     config.get_sweep_batch_size())
+        if compacted:
+            logger.info('Compacted %s idle sessions', compacted)
+
+
 def on_cancel(bot, update, user_data):
     return enter_state_init_order_cancelled(bot, update, user_data)
 
@@ -870,47 +1192,65 @@ def service_channel_courier_query_handler(bot, update, user_data):
             raise Order.DoesNotExist()
     except Order.DoesNotExist:
         logger.info('Order №{} not found!'.format(order_id))
-    else:
-        try:
-            courier = Courier.get(telegram_id=courier_id)
-        except Courier.DoesNotExist:
-            pass
+        return
+
+    courier = courier_index.get(courier_id)
+    if courier is None:
+        bot.answer_callback_query(query.id,
+                                  text=_('Only couriers can take orders'))
+        return
+    if order.location_id is not None \
+            and order.location_id not in courier.location_ids:
+        bot.answer_callback_query(
+            query.id,
+            text=_('{} your location and customer locations are '
+                   'different').format(courier_nickname))
+        return
+    if not claim_order(order.id, courier.id):
+        bot.answer_callback_query(
+            query.id, text=_('Order №{} is already taken').format(order_id))
+        return
+
+    # the other couriers' offers are withdrawn, the taken one gets the
+    # drop button
+    chat_id = str(query.message.chat_id)
+    withdraw_offers(bot, order.id, keep_chat_id=chat_id)
+    add_offer(order.id, chat_id, query.message.message_id)
+    bot.edit_message_reply_markup(
+        chat_id=query.message.chat_id,
+        message_id=query.message.message_id,
+        reply_markup=create_drop_responsibility_keyboard(
+            user_id, courier_nickname, order_id),
+    )
+    bot.send_message(
+        config.get_service_channel(),
+        text='Courier: {}, apply for order №{}. '
+             'Confirm this?'.format(
+            courier_nickname, order_id),
+        reply_markup=create_courier_confirmation_keyboard(
+            order_id, courier_nickname),
+    )
+    bot.answer_callback_query(
+        query.id,
+        text=_('Courier {} assigned').format(courier_nickname))
 
-        else:
-            try:
-                CourierLocation.get(courier=courier, location=order.location)
-                order.courier = courier
-                order.save()
-                bot.delete_message(config.get_couriers_channel(),
-                                   message_id=query.message.message_id)
-                bot.send_message(
-                    config.get_couriers_channel(),
-                    text=query.message.text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=create_drop_responsibility_keyboard(
-                        user_id, courier_nickname, order_id),
-                )
-                bot.send_message(
-                    config.get_service_channel(),
-                    text='Courier: {}, apply for order №{}. '
-                         'Confirm this?'.format(
-                        courier_nickname, order_id),
-                    reply_markup=create_courier_confirmation_keyboard(
-                        order_id, courier_nickname),
-                )
-                bot.answer_callback_query(
-                    query.id,
-                    text=_('Courier {} assigned').format(courier_nickname))
-            except CourierLocation.DoesNotExist:
-                bot.send_message(
-                    config.get_couriers_channel(),
-                    text='{} your location and customer locations are '
-                         'different'.format(courier_nickname),
-                    parse_mode=ParseMode.HTML
-                )
+
+def update_member_cache(chat, users, status):
+    # channels may be configured by id or by @nickname
+    chat_ids = [chat.id]
+    if chat.username:
+        chat_ids.append('@{}'.format(chat.username))
+    for user in users:
+        if user:
+            for chat_id in chat_ids:
+                set_cached_member_status(chat_id, user.id, status)
 
 
 def send_welcome_message(bot, update):
+    update_member_cache(update.message.chat,
+                        update.message.new_chat_members, 'member')
+    update_member_cache(update.message.chat,
+                        [update.message.left_chat_member], 'left')
     if str(update.message.chat_id) == config.get_couriers_channel():
         users = update.message.new_chat_members
         for user in users:
@@ -977,14 +1317,9 @@ def on_statistics_menu(bot, update):
         query.answer()
         return ADMIN_MENU
     elif data == 'statistics_all_sells':
-        orders_count = Order.select().where(Order.confirmed == True).count()
-        total_price = 0
-        orders_items = OrderItem.select().join(Order).where(
-            Order.confirmed == True)
-        for order_item in orders_items:
-            total_price += order_item.count * order_item.total_price
+        stats = get_total_stats()
         message = _('Total confirmed orders\n\ncount: {}\ntotal cost: {}').format(
-            orders_count, total_price)
+            stats.orders, stats.revenue)
         bot.edit_message_text(chat_id=query.message.chat_id,
                               message_id=query.message.message_id,
                               text=message,
@@ -994,17 +1329,9 @@ def on_statistics_menu(bot, update):
         return ADMIN_STATISTICS
     elif data == 'statistics_couriers':
         msg = ''
-        couriers = Courier.select()
-        for courier in couriers:
-            orders_count = Order.select().where(Order.courier == courier,
-                                                Order.confirmed == True).count()
-            total_price = 0
-            orders_items = OrderItem.select().join(Order).where(
-                Order.confirmed == True, Order.courier == courier)
-            for order_item in orders_items:
-                total_price += order_item.count * order_item.total_price
+        for stats in get_courier_stats():
             msg += _('Courier: `@{}`\nOrders: {}, orders cost {}').format(
-                courier.username, orders_count, total_price)
+                stats.name, stats.orders, stats.revenue)
         bot.edit_message_text(chat_id=query.message.chat_id,
                               message_id=query.message.message_id,
                               text=msg,
@@ -1014,17 +1341,9 @@ def on_statistics_menu(bot, update):
         return ADMIN_STATISTICS
     elif data == 'statistics_locations':
         msg = ''
-        locations = Location.select()
-        for location in locations:
-            orders_count = Order.select().where(Order.location == location,
-                                                Order.confirmed == True).count()
-            total_price = 0
-            orders_items = OrderItem.select().join(Order).where(
-                Order.confirmed == True, Order.location == location)
-            for order_item in orders_items:
-                total_price += order_item.count * order_item.total_price
+        for stats in get_location_stats():
             msg += _('Location: {}\nOrders: {}, orders cost {}').format(
-                location.title, orders_count, total_price)
+                stats.name, stats.orders, stats.revenue)
             msg += '\n\n'
         bot.edit_message_text(chat_id=query.message.chat_id,
                               message_id=query.message.message_id,
@@ -1034,16 +1353,9 @@ def on_statistics_menu(bot, update):
         query.answer()
         return ADMIN_STATISTICS
     elif data == 'statistics_yearly':
-        now = datetime.datetime.now()
-        orders_count = Order.select().where(Order.date_created.year == now.year,
-                                            Order.confirmed == True).count()
-        total_price = 0
-        orders_items = OrderItem.select().join(Order).where(
-            Order.confirmed == True, Order.date_created.year == now.year)
-        for order_item in orders_items:
-            total_price += order_item.count * order_item.total_price
+        stats = get_yearly_stats()
         msg = _('Orders: {}, orders cost {}').format(
-            orders_count, total_price)
+            stats.orders, stats.revenue)
         bot.edit_message_text(chat_id=query.message.chat_id,
                               message_id=query.message.message_id,
                               text=msg,
@@ -1052,16 +1364,9 @@ def on_statistics_menu(bot, update):
         query.answer()
         return ADMIN_STATISTICS
     elif data == 'statistics_monthly':
-        now = datetime.datetime.now()
-        orders_count = Order.select().where(Order.date_created.year == now.month,
-                                            Order.confirmed == True).count()
-        total_price = 0
-        orders_items = OrderItem.select().join(Order).where(
-            Order.confirmed == True, Order.date_created.year == now.month)
-        for order_item in orders_items:
-            total_price += order_item.count * order_item.total_price
+        stats = get_monthly_stats()
         msg = _('Orders: {}, orders cost {}').format(
-            orders_count, total_price)
+            stats.orders, stats.revenue)
         bot.edit_message_text(chat_id=query.message.chat_id,
                               message_id=query.message.message_id,
                               text=msg,
@@ -1071,17 +1376,9 @@ def on_statistics_menu(bot, update):
         return ADMIN_STATISTICS
     elif data == 'statistics_user':
         msg = ''
-        users = User.select()
-        for user in users:
-            orders_count = Order.select().where(Order.user == user,
-                                                Order.confirmed == True).count()
-            total_price = 0
-            orders_items = OrderItem.select().join(Order).where(
-                Order.confirmed == True, Order.location == user)
-            for order_item in orders_items:
-                total_price += order_item.count * order_item.total_price
+        for stats in get_user_stats():
             msg += '\nUser: @{}, orders: {}, orders cost {}'.format(
-                user.username, orders_count, total_price)
+                stats.name, stats.orders, stats.revenue)
         bot.edit_message_text(chat_id=query.message.chat_id,
                               message_id=query.message.message_id,
                               text=msg,
@@ -1105,6 +1402,14 @@ def on_bot_settings_menu(bot, update):
                               parse_mode=ParseMode.MARKDOWN)
         query.answer()
         return ADMIN_MENU
+    elif data == 'bot_settings_language':
+        bot.edit_message_text(chat_id=query.message.chat_id,
+                              message_id=query.message.message_id,
+                              text=_('🌐 Language'),
+                              reply_markup=create_bot_language_keyboard(),
+                              parse_mode=ParseMode.MARKDOWN)
+        query.answer()
+        return ADMIN_BOT_SETTINGS
     elif data == 'bot_settings_couriers':
         bot.edit_message_text(chat_id=query.message.chat_id,
                               message_id=query.message.message_id,
@@ -1383,18 +1688,18 @@ def on_admin_ban_list(bot, update):
 
 
 def main():
-    user_conversation_handler = ConversationHandler(
+    user_conversation_handler = ThreadSafeConversationHandler(
         entry_points=[CommandHandler('start', on_start, pass_user_data=True),
                       CommandHandler('admin', on_start_admin),
                       CallbackQueryHandler(fallback_query_handler,
-                                           pattern='^(menu|product)',
+                                           pattern='^(menu|product|catalog)',
                                            pass_user_data=True)],
         states={
             BOT_STATE_INIT: [
                 CommandHandler('start', on_start, pass_user_data=True),
                 CommandHandler('admin', on_start_admin),
                 CallbackQueryHandler(
-                    on_menu, pattern='^(menu|product)', pass_user_data=True)
+                    on_menu, pattern='^(menu|product|catalog)', pass_user_data=True)
             ],
             BOT_STATE_CHECKOUT_SHIPPING: [
                 CallbackQueryHandler(checkout_fallback_command_handler,
@@ -1460,8 +1765,12 @@ def main():
                 on_settings_menu, pattern='^settings')],
             ADMIN_STATISTICS: [CallbackQueryHandler(
                 on_statistics_menu, pattern='^statistics')],
-            ADMIN_BOT_SETTINGS: [CallbackQueryHandler(
-                on_bot_settings_menu, pattern='^bot_settings')],
+            ADMIN_BOT_SETTINGS: [
+                CallbackQueryHandler(
+                    on_bot_settings_menu, pattern='^bot_settings'),
+                CallbackQueryHandler(
+                    on_bot_language_change, pattern='^lng_',
+                    pass_user_data=True)],
             ADMIN_COURIERS: [
                 CallbackQueryHandler(
                     on_admin_couriers, pattern='^bot_couriers')],
@@ -1657,7 +1966,12 @@ def main():
             CommandHandler('start', on_start, pass_user_data=True)
         ])
 
-    updater = Updater(config.get_api_token())
+    workers = config.get_server_workers()
+    scheduler = SendScheduler(config.get_messages_per_second(),
+                              config.get_group_messages_per_minute())
+    # the updater's own pool, update handling and the order events consumer
+    request = ThrottledRequest(scheduler, con_pool_size=workers + 6)
+    updater = Updater(bot=Bot(config.get_api_token(), request=request))
     updater.dispatcher.add_handler(MessageHandler(
         Filters.status_update, send_welcome_message))
     updater.dispatcher.add_handler(user_conversation_handler)
@@ -1669,6 +1983,10 @@ def main():
         CallbackQueryHandler(resend_responsibility_keyboard,
                              pattern='^dropped',
                              pass_user_data=True))
+    updater.dispatcher.add_handler(
+        CallbackQueryHandler(on_order_delivered,
+                             pattern='^delivered',
+                             pass_user_data=True))
     updater.dispatcher.add_handler(
         CallbackQueryHandler(make_confirm,
                              pattern='^confirmed',
@@ -1678,10 +1996,32 @@ def main():
                              pattern='^notconfirmed',
                              pass_user_data=True))
     updater.dispatcher.add_error_handler(on_error)
-    updater.start_polling()
+    translator.default = config.get_default_locale()
+    invalidation_listener.start()
+    order_events.start(partial(post_order_event, updater.bot))
+    schedule_exclusive(updater.job_queue, 'order_sweep', sweep_orders,
+                       config.get_sweep_interval())
+    schedule_exclusive(updater.job_queue, 'session_compaction',
+                       compact_idle_sessions, config.get_compact_interval())
+    install_update_pool(updater.dispatcher, workers)
+    start_updater(updater, config)
     updater.idle()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shop bot for telegram')
+    parser.add_argument(
+        'command', nargs='?', default='run',
+        choices=['run', 'rebuild_statistics'],
+        help='run the bot (default) or rebuild the daily sales rollup '
+             'from all confirmed orders')
+    args = parser.parse_args()
+    init_database(config.get_database_url())
     create_tables()
-    main()
+    user_sessions.ttl = config.get_session_ttl()
+    migrate_keyspace()
+    if args.command == 'rebuild_statistics':
+        rows = rebuild_daily_sales()
+        logger.info('Daily sales rebuilt, %s rows', rows)
+    else:
+        main()
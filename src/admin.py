@@ -3,25 +3,25 @@ import os
 
 from telegram import ParseMode, Message, CallbackQuery
 from telegram import ReplyKeyboardRemove
-from telegram.error import TelegramError
+from telegram.error import TelegramError, BadRequest
 from telegram.ext import ConversationHandler
 
 from .enums import *
 from .enums import _
-from .helpers import ConfigHelper, session_client, get_config_session, \
-    get_user_session, get_user_id, set_config_session
-from .models import Product, ProductCount, Courier, Location, CourierLocation
+from .helpers import ConfigHelper, get_config_session, \
+    get_user_session, get_user_id, set_config_session, catalog, \
+    get_cached_member_status, get_product_summaries, get_product_summary, \
+    set_cached_member_status, NOT_MEMBER_STATUSES
+from .dispatch import courier_index
+from .images import image_store
+from .models import Product, ProductCount, Courier, Location, \
+    CourierLocation, db
 from .keyboards import create_bot_config_keyboard, create_back_button, \
     create_bot_couriers_keyboard, create_bot_channels_keyboard, \
     create_bot_settings_keyboard, create_bot_order_options_keyboard, \
     create_ban_list_keyboard, create_courier_locations_keyboard, create_bot_locations_keyboard
 
 DEBUG = os.environ.get('DEBUG')
-cat = gettext.GNUTranslations(open('he.mo', 'rb'))
-
-_ = gettext.gettext
-if not DEBUG:
-    _ = cat.gettext
 
 logging.basicConfig(stream=sys.stderr, format='%(asctime)s %(message)s',
                     level=logging.INFO)
@@ -32,15 +32,26 @@ else:
     config = ConfigHelper()
 
 
+def is_chat_member(bot, chat_id, user_id):
+    status = get_cached_member_status(chat_id, user_id)
+    if status is None:
+        try:
+            status = bot.getChatMember(chat_id, user_id).status
+        except BadRequest as e:
+            # e.g. a wrong chat id in the config, not cached so it's seen
+            # again once fixed
+            logger.error('Failed to check member %s of %s: %s',
+                         user_id, chat_id, e)
+            return False
+        set_cached_member_status(chat_id, user_id, status)
+    return status not in NOT_MEMBER_STATUSES
+
+
 def is_admin(bot, user_id):
     chat_id = config.get_service_channel()
 
     try:
-        member = bot.getChatMember(chat_id, user_id)
-        if member.status == 'left':
-            return False
-        else:
-            return True
+        return is_chat_member(bot, chat_id, user_id)
     except TelegramError as e:
         logger.error("Failed to check admin id: %s", e)
         return False
@@ -87,8 +98,8 @@ def on_admin_order_options(bot, update):
         )
         return ADMIN_TXT_PRODUCT_TITLE
     elif data == 'bot_order_options_delete_product':
-        products = Product.filter(is_active=True)
-        if products.count() == 0:
+        products = get_product_summaries()
+        if not products:
             query = update.callback_query
             bot.edit_message_text(chat_id=query.message.chat_id,
                                   message_id=query.message.message_id,
@@ -255,11 +266,13 @@ def on_admin_txt_product_photo(bot, update, user_data):
 
     title = user_data['add_product']['title']
     prices = user_data['add_product']['prices']
-    image_data = stream.getvalue()
+    image_hash = image_store.put(stream.getvalue())
 
-    product = Product.create(title=title, image=image_data)
-    for count, price in prices:
-        ProductCount.create(product=product, price=price, count=count)
+    with db.atomic():
+        product = Product.create(title=title, image_hash=image_hash)
+        for count, price in prices:
+            ProductCount.create(product=product, price=price, count=count)
+    catalog.rebuild()
 
     # clear new product data
     del user_data['add_product']
@@ -272,8 +285,8 @@ def on_admin_txt_product_photo(bot, update, user_data):
 
 
 def on_admin_cmd_delete_product(bot, update):
-    products = Product.filter(is_active=True)
-    if products.count() == 0:
+    products = get_product_summaries()
+    if not products:
         update.message.reply_text(text='No products to delete')
         return ADMIN_INIT
     else:
@@ -325,12 +338,13 @@ def on_admin_txt_delete_product(bot, update, user_data):
                               parse_mode=ParseMode.MARKDOWN)
         return ADMIN_ORDER_OPTIONS
     product_id = update.message.text
-    try:
-        # get title to check if product is valid
-        product = Product.get(id=product_id)
+    # get title to check if product is valid
+    product = get_product_summary(product_id)
+    if product is not None:
         product_title = product.title
-        product.is_active = False
-        product.save()
+        Product.update(is_active=False).where(
+            Product.id == product.id).execute()
+        catalog.rebuild()
         update.message.reply_text(
             text=_('Product {} - {} was deleted').format(product_id, product_title))
         logger.info('Product %s - %s was deleted', product_id, product_title)
@@ -340,7 +354,7 @@ def on_admin_txt_delete_product(bot, update, user_data):
             parse_mode=ParseMode.MARKDOWN,
         )
         return ADMIN_ORDER_OPTIONS
-    except Product.DoesNotExist:
+    else:
         update.message.reply_text(
             text='Invalid product id, please enter number')
         return ADMIN_TXT_DELETE_PRODUCT
@@ -394,7 +408,11 @@ def on_admin_txt_delete_location(bot, update, user_data):
     lct = update.callback_query.data
     try:
         location = Location.get(title=lct)
-        location.delete_instance()
+        with db.atomic():
+            CourierLocation.delete().where(
+                CourierLocation.location == location).execute()
+            location.delete_instance()
+        courier_index.rebuild()
     except Location.DoesNotExist:
         update.message.reply_text(
             text='Invalid Location title, please enter correct title')
@@ -463,9 +481,12 @@ def on_admin_btn_courier_location(bot, update, user_data):
             query.message.reply_text(text='Courier with username @{} '
                                           'already added'.format(username))
         except Courier.DoesNotExist:
-            courier = Courier.create(username=username, telegram_id=telegram_id)
-            for location in locations:
-                CourierLocation.create(courier=courier, location=location)
+            with db.atomic():
+                courier = Courier.create(username=username,
+                                         telegram_id=telegram_id)
+                for location in locations:
+                    CourierLocation.create(courier=courier, location=location)
+            courier_index.rebuild()
             # clear new courier data
             del user_data['add_courier']
             bot.send_message(chat_id=query.message.chat_id,
@@ -527,7 +548,11 @@ def on_admin_txt_delete_courier(bot, update, user_data):
             text='Invalid courier id, please enter correct id')
         return ADMIN_TXT_DELETE_COURIER
 
-    courier.delete_instance()
+    with db.atomic():
+        CourierLocation.delete().where(
+            CourierLocation.courier == courier).execute()
+        courier.delete_instance()
+    courier_index.rebuild()
     bot.send_message(chat_id=update.message.chat_id,
                      text=_('Courier deleted'),
                      reply_markup=create_bot_couriers_keyboard(),
@@ -563,7 +588,7 @@ def new_welcome_message(bot, update):
     new_text = update.message.text
     session = get_config_session()
     session['welcome_text'] = new_text
-    session_client.json_set('config', session)
+    set_config_session(session)
     return on_start_admin(bot, update)
 
 
@@ -0,0 +1,147 @@
+import logging
+from collections import namedtuple
+
+from .helpers import ReadIndex, cache_key, invalidation_listener, \
+    session_client
+from .models import Courier, CourierLocation, Order, OrderStatus
+from .orders import transition_order
+
+logger = logging.getLogger(__name__)
+
+OFFERS_TTL = 7 * 24 * 3600
+
+CourierInfo = namedtuple('CourierInfo',
+                         ['id', 'telegram_id', 'username', 'location_ids'])
+
+
+# couriers by telegram id and by the locations they serve
+class CourierIndex(ReadIndex):
+    name = 'couriers'
+    version_key = cache_key('couriers_version')
+
+    def get(self, telegram_id):
+        by_telegram_id, by_location = self.get_data()
+        return by_telegram_id.get(telegram_id)
+
+    def for_location(self, location_id):
+        by_telegram_id, by_location = self.get_data()
+        return by_location.get(location_id, ())
+
+    def load(self):
+        location_ids = {}
+        rows = CourierLocation.select(
+            CourierLocation.courier, CourierLocation.location).tuples()
+        for courier_id, location_id in rows:
+            location_ids.setdefault(courier_id, set()).add(location_id)
+
+        by_telegram_id = {}
+        by_location = {}
+        rows = Courier.select(
+            Courier.id, Courier.telegram_id, Courier.username
+        ).order_by(Courier.id.asc()).tuples()
+        for courier_id, telegram_id, username in rows:
+            courier = CourierInfo(
+                courier_id, telegram_id, username,
+                frozenset(location_ids.get(courier_id, ())))
+            by_telegram_id[telegram_id] = courier
+            for location_id in courier.location_ids:
+                by_location.setdefault(location_id, []).append(courier)
+        return by_telegram_id, {location_id: tuple(couriers) for
+                                location_id, couriers in by_location.items()}
+
+
+# channels may be configured by @username, offers are kept by the numeric
+# chat id telegram reports in callback queries
+channel_ids = {}
+
+
+def resolve_chat_id(bot, chat_id):
+    if isinstance(chat_id, str) and chat_id.startswith('@'):
+        resolved = channel_ids.get(chat_id)
+        if resolved is None:
+            resolved = channel_ids[chat_id] = bot.get_chat(chat_id).id
+        return resolved
+    return int(chat_id)
+
+
+def offers_key(order_id):
+    return cache_key('order_offers:{}'.format(order_id))
+
+
+def get_offers(order_id):
+    # {chat id: message id} of the offer messages sent for an order, chat ids
+    # are kept as strings since a channel may be given by its @username
+    offers = session_client.hgetall(offers_key(order_id))
+    return {chat_id.decode('utf-8'): int(message_id)
+            for chat_id, message_id in offers.items()}
+
+
+def add_offer(order_id, chat_id, message_id):
+    key = offers_key(order_id)
+    pipe = session_client.pipeline()
+    pipe.hset(key, str(chat_id), message_id)
+    pipe.expire(key, OFFERS_TTL)
+    pipe.execute()
+
+
+def clear_offers(order_id):
+    session_client.delete(offers_key(order_id))
+
+
+def saved_offer_key(order_id):
+    return cache_key('order_offer:{}'.format(order_id))
+
+
+def save_offer(order_id, user_id, location_id, text, parse_mode=None):
+    # the first offer of an order is kept to offer it again later
+    key = saved_offer_key(order_id)
+    if session_client.exists(key):
+        return
+    pipe = session_client.pipeline()
+    pipe.hmset(key, {'user_id': user_id,
+                     'location_id': '' if location_id is None else location_id,
+                     'text': text, 'parse_mode': parse_mode or ''})
+    pipe.expire(key, OFFERS_TTL)
+    pipe.execute()
+
+
+def get_saved_offer(order_id):
+    fields = session_client.hgetall(saved_offer_key(order_id))
+    if not fields:
+        return None
+    offer = {field.decode('utf-8'): value.decode('utf-8')
+             for field, value in fields.items()}
+    offer['user_id'] = int(offer['user_id'])
+    offer['location_id'] = int(offer['location_id']) \
+        if offer['location_id'] else None
+    offer['parse_mode'] = offer['parse_mode'] or None
+    return offer
+
+
+def mark_order_offered(order_id):
+    # a redelivered order event must not undo a claim
+    return transition_order(order_id, OrderStatus.OFFERED,
+                            Order.status == OrderStatus.CREATED.value)
+
+
+def is_open_order(order_id):
+    status = Order.select(Order.status).where(Order.id == order_id).scalar()
+    return status in (OrderStatus.CREATED.value, OrderStatus.OFFERED.value)
+
+
+def claim_order(order_id, courier_id):
+    # only one courier gets the order, however many click at the same time
+    return transition_order(order_id, OrderStatus.CLAIMED,
+                            Order.courier >> None, courier=courier_id)
+
+
+def release_order(order_id, courier_id=None):
+    conditions = []
+    if courier_id is not None:
+        conditions.append(Order.courier == courier_id)
+    return transition_order(order_id, OrderStatus.OFFERED, *conditions,
+                            courier=None)
+
+
+courier_index = CourierIndex()
+invalidation_listener.register('couriers', courier_index.invalidate)
@@ -1,11 +1,8 @@
-import gettext
 import logging
 import sys
 
 from src.helpers import ConfigHelper, CartHelper
-
-cat = gettext.GNUTranslations(open('he.mo', 'rb'))
-_ = gettext.gettext
+from src.locales import _, N_
 
 logging.basicConfig(stream=sys.stderr, format='%(asctime)s %(message)s',
                     level=logging.INFO)
@@ -65,10 +62,10 @@ config = ConfigHelper(cfgfilename='test_conf.conf')
  ADMIN_SET_WELCOME_MESSAGE) = range(48)
 
 
-BUTTON_TEXT_PICKUP      = _('🏪 Pickup')
-BUTTON_TEXT_DELIVERY    = _('🚚 Delivery')
-BUTTON_TEXT_NOW         = _('⏰ Now')
-BUTTON_TEXT_SETTIME     = _('📅 Set time')
-BUTTON_TEXT_BACK        = _('↩ Back')
-BUTTON_TEXT_CONFIRM     = _('✅ Confirm')
-BUTTON_TEXT_CANCEL      = _('❌ Cancel')
+BUTTON_TEXT_PICKUP      = N_('🏪 Pickup')
+BUTTON_TEXT_DELIVERY    = N_('🚚 Delivery')
+BUTTON_TEXT_NOW         = N_('⏰ Now')
+BUTTON_TEXT_SETTIME     = N_('📅 Set time')
+BUTTON_TEXT_BACK        = N_('↩ Back')
+BUTTON_TEXT_CONFIRM     = N_('✅ Confirm')
+BUTTON_TEXT_CANCEL      = N_('❌ Cancel')
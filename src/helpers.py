@@ -1,8 +1,16 @@
+import abc
+import bisect
 import configparser
+import datetime
+import logging
+import threading
+import time
 import redis
 import json
+from collections import namedtuple
 
-from .models import ProductCount, Product, User, OrderItem, Courier
+from .models import ProductCount, Product, User, OrderItem, Courier, \
+    AbandonedCart, db
 
 
 # def set_locale(f):
@@ -27,6 +35,29 @@ class JsonRedis(redis.StrictRedis):
         return self.set(name, value)
 
 
+# redis keys by what they hold: sessions expire when idle, config is kept
+# for good, cache entries may be dropped and are made again, orders keep the
+# order event stream and jobs the locks of the scheduled jobs
+def session_key(name):
+    return 'session:{}'.format(name)
+
+
+def config_key(name):
+    return 'config:{}'.format(name)
+
+
+def cache_key(name):
+    return 'cache:{}'.format(name)
+
+
+def orders_key(name):
+    return 'orders:{}'.format(name)
+
+
+def jobs_key(name):
+    return 'jobs:{}'.format(name)
+
+
 class ConfigHelper:
     def __init__(self, cfgfilename='shoppybot.conf'):
         self.config = configparser.ConfigParser(
@@ -43,76 +74,82 @@ class ConfigHelper:
                       'identification_stage2_required': False,
                       'identification_stage2_question': None,
                       'has_courier_option': True,
-                      'only_for_customers': False, 'delivery_fee': 0, })
+                      'only_for_customers': False, 'delivery_fee': 0,
+                      'catalog_mode': 'cards', 'session_ttl': 0,
+                      'cart_ttl': 86400,
+                      'default_locale': 'en', })
         self.config.read(cfgfilename, encoding='utf-8')
         self.section = 'Settings'
+        self.server_section = 'Server'
+        self.database_section = 'Database'
+        self.scheduler_section = 'Scheduler'
 
     def get_api_token(self):
         value = self.config.get(self.section, 'api_token')
         return value.strip()
 
     def get_reviews_channel(self):
-        value = get_config_session().get('reviews_channel')
+        value = get_config_snapshot().get('reviews_channel')
         if value is None:
             value = self.config.get(self.section, 'reviews_channel')
         return value.strip()
 
     def get_service_channel(self):
-        value = get_config_session().get('service_channel')
+        value = get_config_snapshot().get('service_channel')
         if value is None:
             value = self.config.get(self.section, 'service_channel')
         return value.strip()
 
     def get_customers_channel(self):
-        value = get_config_session().get('customers_channel')
+        value = get_config_snapshot().get('customers_channel')
         if value is None:
             value = self.config.get(self.section, 'customers_channel')
         return value.strip()
 
     def get_vip_customers_channel(self):
-        value = get_config_session().get('vip_customers_channel')
+        value = get_config_snapshot().get('vip_customers_channel')
         if value is None:
             value = self.config.get(self.section, 'vip_customers_channel')
         return value.strip()
 
     def get_couriers_channel(self):
-        value = get_config_session().get('couriers_channel')
+        value = get_config_snapshot().get('couriers_channel')
         if value is None:
             value = self.config.get(self.section, 'couriers_channel')
         return value.strip()
 
     def get_welcome_text(self):
-        value = get_config_session().get('welcome_text')
+        value = get_config_snapshot().get('welcome_text')
         if value is None:
             value = self.config.get(self.section, 'welcome_text')
         return value.strip()
 
     def get_order_text(self):
-        value = get_config_session().get('order_text')
+        value = get_config_snapshot().get('order_text')
         if value is None:
             value = self.config.get(self.section, 'order_text')
         return value.strip()
 
     def get_order_complete_text(self):
-        value = get_config_session().get('order_complete_text')
+        value = get_config_snapshot().get('order_complete_text')
         if value is None:
             value = self.config.get(self.section, 'order_complete_text')
         return value.strip()
 
     def get_working_hours(self):
-        value = get_config_session().get('working_hours')
+        value = get_config_snapshot().get('working_hours')
         if value is None:
             value = self.config.get(self.section, 'working_hours')
         return value.strip()
 
     def get_contact_info(self):
-        value = get_config_session().get('contact_info')
+        value = get_config_snapshot().get('contact_info')
         if value is None:
             value = self.config.get(self.section, 'contact_info')
         return value.strip()
 
     def get_phone_number_required(self):
-        value = get_config_session().get('phone_number_required')
+        value = get_config_snapshot().get('phone_number_required')
         if value is None:
             value = self.config.getboolean(
                 self.section, 'phone_number_required')
@@ -121,7 +158,7 @@ class ConfigHelper:
         return value
 
     def get_identification_required(self):
-        value = get_config_session().get('identification_required')
+        value = get_config_snapshot().get('identification_required')
         if value is None:
             value = self.config.getboolean(self.section,
                                            'identification_required')
@@ -130,7 +167,7 @@ class ConfigHelper:
         return value
 
     def get_identification_stage2_required(self):
-        value = get_config_session().get('identification_stage2_required')
+        value = get_config_snapshot().get('identification_stage2_required')
         if value is None:
             value = self.config.getboolean(self.section,
                                            'identification_stage2_required')
@@ -139,14 +176,14 @@ class ConfigHelper:
         return value
 
     def get_identification_stage2_question(self):
-        value = get_config_session().get('identification_stage2_question')
+        value = get_config_snapshot().get('identification_stage2_question')
         if value is None:
             value = self.config.get(self.section,
                                     'identification_stage2_question')
         return value
 
     def get_only_for_customers(self):
-        value = get_config_session().get('only_for_customers')
+        value = get_config_snapshot().get('only_for_customers')
         if value is None:
             value = self.config.getboolean(self.section, 'only_for_customers')
         else:
@@ -154,7 +191,7 @@ class ConfigHelper:
         return value
 
     def get_has_courier_option(self):
-        value = get_config_session().get('has_courier_option')
+        value = get_config_snapshot().get('has_courier_option')
         if value is None:
             value = self.config.getboolean(self.section, 'has_courier_option')
         else:
@@ -162,7 +199,7 @@ class ConfigHelper:
         return value
 
     def get_vip_customers(self):
-        value = get_config_session().get('vip_customers')
+        value = get_config_snapshot().get('vip_customers')
         if value is None:
             value = self.config.getboolean(self.section, 'vip_customers')
         else:
@@ -170,19 +207,19 @@ class ConfigHelper:
         return value
 
     def get_delivery_fee(self):
-        value = get_config_session().get('delivery_fee')
+        value = get_config_snapshot().get('delivery_fee')
         if value is None:
             value = self.config.get(self.section, 'delivery_fee')
         return int(value)
 
     def get_delivery_min(self):
-        value = get_config_session().get('delivery_min')
+        value = get_config_snapshot().get('delivery_min')
         if value is None:
             value = 0
         return int(value)
 
     def get_bot_on_off(self):
-        value = get_config_session().get('bot_on_off')
+        value = get_config_snapshot().get('bot_on_off')
         if value is None:
             value = self.config.getboolean(self.section, 'bot_on_off')
         else:
@@ -190,13 +227,99 @@ class ConfigHelper:
         return value
 
     def get_discount(self):
-        value = get_config_session().get('discount')
+        value = get_config_snapshot().get('discount')
         if value is None:
             value = self.config.get(self.section, 'discount')
         return value
 
+    def get_catalog_mode(self):
+        value = get_config_snapshot().get('catalog_mode')
+        if value is None:
+            value = self.config.get(self.section, 'catalog_mode')
+        return value.strip()
+
+    def get_database_url(self):
+        value = self.config.get(self.database_section, 'url', fallback='')
+        return value.strip()
+
+    def get_server_mode(self):
+        value = self.config.get(self.server_section, 'mode',
+                                fallback='polling')
+        return value.strip()
+
+    def get_server_workers(self):
+        return self.config.getint(self.server_section, 'workers',
+                                  fallback=4)
+
+    def get_messages_per_second(self):
+        return self.config.getint(self.server_section, 'messages_per_second',
+                                  fallback=30)
+
+    def get_group_messages_per_minute(self):
+        return self.config.getint(self.server_section,
+                                  'group_messages_per_minute', fallback=20)
+
+    def get_webhook_listen(self):
+        value = self.config.get(self.server_section, 'listen',
+                                fallback='0.0.0.0')
+        return value.strip()
+
+    def get_webhook_port(self):
+        return self.config.getint(self.server_section, 'port', fallback=8443)
+
+    def get_webhook_url_path(self):
+        value = self.config.get(self.server_section, 'url_path', fallback='')
+        return value.strip()
+
+    def get_webhook_url(self):
+        value = self.config.get(self.server_section, 'webhook_url',
+                                fallback='')
+        return value.strip() or None
+
+    def get_webhook_cert(self):
+        value = self.config.get(self.server_section, 'cert', fallback='')
+        return value.strip() or None
+
+    def get_webhook_key(self):
+        value = self.config.get(self.server_section, 'key', fallback='')
+        return value.strip() or None
+
+    def get_sweep_interval(self):
+        return self.config.getint(self.scheduler_section, 'sweep_interval',
+                                  fallback=60)
+
+    def get_offer_timeout(self):
+        return self.config.getint(self.scheduler_section, 'offer_timeout',
+                                  fallback=600)
+
+    def get_confirm_timeout(self):
+        return self.config.getint(self.scheduler_section, 'confirm_timeout',
+                                  fallback=1800)
+
+    def get_order_expiry(self):
+        return self.config.getint(self.scheduler_section, 'expire_after',
+                                  fallback=86400)
+
+    def get_compact_interval(self):
+        return self.config.getint(self.scheduler_section, 'compact_interval',
+                                  fallback=3600)
+
+    def get_sweep_batch_size(self):
+        return self.config.getint(self.scheduler_section, 'batch_size',
+                                  fallback=50)
+
+    def get_default_locale(self):
+        value = self.config.get(self.section, 'default_locale')
+        return value.strip()
+
+    def get_session_ttl(self):
+        return self.config.getint(self.section, 'session_ttl')
+
+    def get_cart_ttl(self):
+        return self.config.getint(self.section, 'cart_ttl')
+
     def get_banned_users(self):
-        value = get_config_session().get('banned')
+        value = get_config_snapshot().get('banned')
         if value is None:
             value = self.config.get(self.section, 'banned')
         values = value
@@ -204,7 +327,160 @@ class ConfigHelper:
             values = []
         elif isinstance(value, str):
             values = value.split(', ')
-        return values
+        # callers extend the list in place, keep the snapshot untouched
+        return list(values)
+
+
+# title-only view of a product for listings, never loads the whole row
+ProductSummary = namedtuple('ProductSummary', ['id', 'title', 'is_active'])
+
+
+def product_summaries_query():
+    return Product.select(Product.id, Product.title, Product.is_active)
+
+
+def get_product_summaries(active_only=True):
+    query = product_summaries_query()
+    if active_only:
+        query = query.where(Product.is_active == True)
+    return [ProductSummary(product_id, title, bool(is_active))
+            for product_id, title, is_active
+            in query.order_by(Product.id.asc()).tuples()]
+
+
+def get_product_summary(product_id):
+    row = product_summaries_query().where(
+        Product.id == product_id).scalar(as_tuple=True)
+    if row is None:
+        return None
+    product_id, title, is_active = row
+    return ProductSummary(product_id, title, bool(is_active))
+
+
+def get_price_tiers(product_ids=None):
+    # {product id: [(count, price), ...]} sorted by count, one query
+    query = ProductCount.select(
+        ProductCount.product, ProductCount.count, ProductCount.price
+    ).order_by(ProductCount.count.asc())
+    if product_ids is not None:
+        query = query.where(ProductCount.product << product_ids)
+    tiers = {}
+    for product_id, count, price in query.tuples():
+        tiers.setdefault(product_id, []).append((count, price))
+    return tiers
+
+
+def get_tier_price(counts, prices, count):
+    # price of the biggest tier not exceeding count
+    index = bisect.bisect_right(counts, count) - 1
+    if index < 0:
+        return 0
+    return prices[index]
+
+
+class CatalogProduct(namedtuple('CatalogProduct', [
+        'id', 'title', 'is_active', 'image_hash', 'counts', 'prices'])):
+    __slots__ = ()
+
+    @property
+    def tiers(self):
+        return tuple(zip(self.counts, self.prices))
+
+    def tier_index(self, count):
+        # index of the biggest price tier not exceeding count, -1 if none
+        return bisect.bisect_right(self.counts, count) - 1
+
+    def price_for(self, count):
+        return get_tier_price(self.counts, self.prices, count)
+
+
+# in-memory read model built from the db, rebuilt aside and swapped in on
+# changes, other processes drop theirs through the invalidation listener
+class ReadIndex(abc.ABC):
+    name = None
+    version_key = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = None
+        self.version = None
+        # bumped by every invalidation, a load that saw it change is dropped
+        self.generation = 0
+
+    def get_data(self):
+        data = self.data
+        if data is None:
+            with self.lock:
+                if self.data is None:
+                    self.version, self.data = self.read()
+                data = self.data
+        return data
+
+    def read(self):
+        # the version is read first, a change made meanwhile costs a reload
+        # but is never missed
+        version = session_client.get(self.version_key)
+        version = version.decode('utf-8') if version else '0'
+        return version, self.load()
+
+    @abc.abstractmethod
+    def load(self):
+        pass
+
+    def rebuild(self):
+        # build aside and swap the reference, readers never see half an index
+        generation = self.generation
+        data = self.load()
+        version = str(session_client.incr(self.version_key))
+        with self.lock:
+            if generation == self.generation:
+                self.data = data
+                self.version = version
+            else:
+                # changed elsewhere while loading
+                self.data = None
+        invalidation_listener.publish(self.name, version)
+
+    def invalidate(self, version=None):
+        # waits for a load in progress, compared with the version it read
+        with self.lock:
+            if version is None or version != self.version:
+                self.generation += 1
+                self.data = None
+
+
+# read model of products and their price tiers, cart maths never hits the db
+class CatalogIndex(ReadIndex):
+    name = 'catalog'
+    version_key = cache_key('catalog_version')
+
+    def get_products(self):
+        return self.get_data()
+
+    def get(self, product_id):
+        try:
+            product_id = int(product_id)
+        except (TypeError, ValueError):
+            return None
+        return self.get_products().get(product_id)
+
+    def get_active(self):
+        return [product for product in self.get_products().values()
+                if product.is_active]
+
+    def load(self):
+        tiers = get_price_tiers()
+        products = {}
+        rows = Product.select(
+            Product.id, Product.title, Product.is_active, Product.image_hash
+        ).order_by(Product.id.asc()).tuples()
+        for product_id, title, is_active, image_hash in rows:
+            product_tiers = tiers.get(product_id, [])
+            products[product_id] = CatalogProduct(
+                product_id, title, bool(is_active), image_hash,
+                tuple(count for count, price in product_tiers),
+                tuple(price for count, price in product_tiers))
+        return products
 
 
 class CartHelper:
@@ -220,19 +496,17 @@ class CartHelper:
     def add(self, user_data, product_id):
         cart = self.check_cart(user_data)
         product_id = str(product_id)
-        prices = ProductCount.select().where(
-            ProductCount.product == product_id).order_by(
-            ProductCount.count.asc())
-        counts = [x.count for x in prices]
-        min_count = counts[0]
+        product = catalog.get(product_id)
+        if product is None or not product.counts:
+            return user_data
+        counts = product.counts
 
         if product_id not in cart:
             # add minimum product count (usually 1)
-            cart[product_id] = min_count
+            cart[product_id] = counts[0]
         else:
             # add more
-            current_count = cart[product_id]
-            current_count_index = counts.index(current_count)
+            current_count_index = product.tier_index(cart[product_id])
             # iterate through possible product counts for next price
             next_count_index = (current_count_index + 1) % len(counts)
             cart[product_id] = counts[next_count_index]
@@ -243,21 +517,18 @@ class CartHelper:
     def remove(self, user_data, product_id):
         cart = self.check_cart(user_data)
         product_id = str(product_id)
-
-        prices = ProductCount.select().where(
-            ProductCount.product == product_id).order_by(
-            ProductCount.count.asc())
-        counts = [x.count for x in prices]
+        product = catalog.get(product_id)
 
         if product_id in cart:
-            current_count = cart[product_id]
-            current_count_index = counts.index(current_count)
+            current_count_index = -1
+            if product is not None:
+                current_count_index = product.tier_index(cart[product_id])
 
-            if current_count_index == 0:
+            if current_count_index <= 0:
                 del cart[product_id]
             else:
                 next_count_index = current_count_index - 1
-                cart[product_id] = counts[next_count_index]
+                cart[product_id] = product.counts[next_count_index]
         user_data['cart'] = cart
 
         return user_data
@@ -274,28 +545,22 @@ class CartHelper:
 
     def get_product_info(self, user_data, product_id, for_order=False):
         result = None
-        try:
-            product_title = Product.get(id=product_id).title
-        except Product.DoesNotExist:
+        product = catalog.get(product_id)
+        if product is None:
             return result
         product_count = self.get_product_count(user_data, product_id)
-        product_price = ProductCount.get(
-            product_id=product_id, count=product_count).price
+        product_price = product.price_for(product_count)
         if for_order:
             result = product_id, product_count, product_price
         else:
-            result = product_title, product_count, product_price
+            result = product.title, product_count, product_price
         return result
 
     def product_full_info(self, user_data, product_id):
-        try:
-            product_title = Product.get(id=product_id).title
-        except Product.DoesNotExist:
+        product = catalog.get(product_id)
+        if product is None:
             return '', []
-        rows = ProductCount.select(
-            ProductCount.count, ProductCount.price).where(
-            ProductCount.product == product_id).tuples()
-        return product_title, rows
+        return product.title, product.tiers
 
     def get_product_ids(self, user_data):
         cart = self.check_cart(user_data)
@@ -317,16 +582,12 @@ class CartHelper:
         return len(cart) > 0
 
     def get_product_subtotal(self, user_data, product_id):
+        product = catalog.get(product_id)
+        if product is None:
+            return 0
         count = self.get_product_count(user_data, product_id)
 
-        rows = ProductCount.filter(product_id=product_id)
-        min_price = 0
-        for row in rows:
-            price, product_count = row.price, row.count
-            if count >= product_count:
-                min_price = price
-
-        return min_price
+        return product.price_for(count)
 
     def get_cart_total(self, user_data):
         cart = self.check_cart(user_data)
@@ -338,33 +599,258 @@ class CartHelper:
         return total
 
     def fill_order(self, user_data, order):
-        products = self.get_products_info(user_data, for_order=True)
-        for p_id, p_count, p_price in products:
-            OrderItem.create(order=order, product_id=p_id, count=p_count,
-                             total_price=p_price)
+        cart = self.check_cart(user_data)
+        product_ids = [int(product_id) for product_id in cart]
+        if not product_ids:
+            return
+        # prices are checked against the db, not the cached catalog
+        tiers = get_price_tiers(product_ids)
+        rows = []
+        for product_id in product_ids:
+            product_tiers = tiers.get(product_id)
+            if not product_tiers:
+                continue
+            count = cart[str(product_id)]
+            price = get_tier_price(
+                [tier_count for tier_count, tier_price in product_tiers],
+                [tier_price for tier_count, tier_price in product_tiers],
+                count)
+            rows.append(dict(order=order.id, product=product_id,
+                             count=count, total_price=price))
+        if rows:
+            OrderItem.insert_many(rows).execute()
+
+
+# user session as a redis hash: "cart:<product_id>" holds the count,
+# "shipping:<key>" and any other top level keys hold json values
+def flatten_session(session):
+    fields = {}
+    for key, value in session.items():
+        if key == 'cart':
+            for product_id, count in value.items():
+                fields['cart:{}'.format(product_id)] = str(count)
+        elif key == 'shipping':
+            for name, item in value.items():
+                fields['shipping:{}'.format(name)] = json.dumps(item)
+        else:
+            fields[key] = json.dumps(value)
+    return fields
+
+
+def unflatten_session(fields):
+    session = {'cart': {}, 'shipping': {}}
+    for field, value in fields.items():
+        prefix, sep, name = field.partition(':')
+        if sep and prefix == 'cart':
+            session['cart'][name] = int(value)
+        elif sep and prefix == 'shipping':
+            session['shipping'][name] = json.loads(value)
+        else:
+            session[field] = json.loads(value)
+    return session
+
+
+class UserSession(dict):
+    def __init__(self, fields):
+        super().__init__(unflatten_session(fields))
+        # hash fields as they are stored in redis, used to write only changes
+        self.fields = fields
+
+
+COMPACT_SESSION_SCRIPT = '''
+local last_active = redis.call('ZSCORE', KEYS[2], ARGV[1])
+if last_active and tonumber(last_active) > tonumber(ARGV[2]) then
+    return 0
+end
+if #ARGV > 2 then
+    redis.call('HDEL', KEYS[1], unpack(ARGV, 3))
+end
+redis.call('ZREM', KEYS[2], ARGV[1])
+return 1
+'''
+
+
+class SessionStore:
+    # user ids by the time their session was last used
+    activity_key = session_key('activity')
+
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self.local = threading.local()
+
+    def key(self, user_id):
+        return session_key(user_id)
+
+    def touch(self, pipe, user_id):
+        pipe.zadd(self.activity_key, time.time(), user_id)
+        if self.ttl:
+            pipe.expire(self.key(user_id), self.ttl)
+
+    # sessions read during an update are kept in memory and written once
+    # when it's done, see flush()
+    def begin(self):
+        self.local.sessions = {}
+        self.local.dirty = set()
+
+    def flush(self):
+        sessions = getattr(self.local, 'sessions', None)
+        if sessions is None:
+            return
+        try:
+            for user_id in self.local.dirty:
+                self.write(user_id, sessions[user_id])
+        finally:
+            self.local.sessions = None
+            self.local.dirty = None
+
+    def get(self, user_id):
+        sessions = getattr(self.local, 'sessions', None)
+        if sessions is not None and user_id in sessions:
+            return sessions[user_id]
+        session = self.load(user_id)
+        if sessions is not None:
+            sessions[user_id] = session
+        return session
+
+    def find(self, user_id):
+        # the session of the user if there is one, None instead of a new one
+        sessions = getattr(self.local, 'sessions', None)
+        if sessions is not None and user_id in sessions:
+            return sessions[user_id]
+        if not session_client.exists(self.key(user_id)):
+            return None
+        return self.get(user_id)
+
+    def save(self, user_id, session):
+        sessions = getattr(self.local, 'sessions', None)
+        if sessions is None:
+            self.write(user_id, session)
+        else:
+            sessions[user_id] = session
+            self.local.dirty.add(user_id)
+
+    def load(self, user_id):
+        key = self.key(user_id)
+        pipe = session_client.pipeline()
+        pipe.hgetall(key)
+        self.touch(pipe, user_id)
+        try:
+            fields = pipe.execute()[0]
+        except redis.ResponseError:
+            # session stored by the previous version as a json string
+            session = session_client.json_get(key)
+            session_client.delete(key)
+            self.write(user_id, session)
+            fields = session_client.hgetall(key)
+        if not fields:
+            session = UserSession({})
+            session['locale'] = User.select(User.locale).where(
+                User.telegram_id == user_id).scalar()
+            self.write(user_id, session)
+            return session
+        return UserSession({field.decode('utf-8'): value.decode('utf-8')
+                            for field, value in fields.items()})
+
+    def write(self, user_id, session):
+        key = self.key(user_id)
+        fields = flatten_session(session)
+        old_fields = getattr(session, 'fields', None)
+        pipe = session_client.pipeline()
+        if old_fields is None:
+            # not read from the store, replace the whole hash
+            pipe.delete(key)
+            old_fields = {}
+        removed = [field for field in old_fields if field not in fields]
+        changed = {field: value for field, value in fields.items()
+                   if old_fields.get(field) != value}
+        if removed:
+            pipe.hdel(key, *removed)
+        if changed:
+            pipe.hmset(key, changed)
+        self.touch(pipe, user_id)
+        pipe.execute()
+        if isinstance(session, UserSession):
+            session.fields = fields
+
+    def idle_user_ids(self, idle_since, limit):
+        return [int(user_id) for user_id in session_client.zrangebyscore(
+            self.activity_key, '-inf', idle_since, start=0, num=limit)]
+
+    def compact(self, user_id, idle_since, archive):
+        # hands the cart of a session unused since idle_since to
+        # archive(user_id, cart, last_active) and drops it from the session,
+        # False if the session was used meanwhile
+        key = self.key(user_id)
+        last_active = session_client.zscore(self.activity_key, user_id)
+        if last_active is not None and last_active > idle_since:
+            return False
+        cart = {}
+        for field, value in session_client.hgetall(key).items():
+            prefix, sep, product_id = field.decode('utf-8').partition(':')
+            if sep and prefix == 'cart':
+                cart[field] = (int(product_id), int(value))
+        # every read or write of the session bumps its score in the same
+        # transaction, the script drops the cart only if it wasn't bumped
+        # since and the archived rows are kept only if it did
+        with db.atomic() as transaction:
+            if cart:
+                archive(user_id, dict(cart.values()), last_active)
+            dropped = session_client.eval(
+                COMPACT_SESSION_SCRIPT, 2, key, self.activity_key, user_id,
+                idle_since, *cart)
+            if not dropped:
+                transaction.rollback()
+        return bool(dropped)
 
 
 def get_user_session(user_id):
-    user_session = session_client.json_get(user_id)
-    updated = False
+    return user_sessions.get(user_id)
+
+
+def save_user_session(user_id, session):
+    user_sessions.save(user_id, session)
+
 
-    if not user_session:
-        user = User.get(telegram_id=user_id)
-        session_client.json_set(user_id, {'locale': user.locale})
-        user_session = session_client.json_get(user_id)
+def get_user_locale(user_id):
+    # users who have no session yet don't get one just for the lookup
+    session = user_sessions.find(user_id)
+    if session is not None:
+        return session.get('locale')
+    return User.select(User.locale).where(
+        User.telegram_id == user_id).scalar()
 
-    if not user_session.get('cart'):
-        user_session["cart"] = {}
-        updated = True
 
-    if not user_session.get('shipping'):
-        user_session["shipping"] = {}
-        updated = True
+def set_user_locale(user_id, locale):
+    User.update(locale=locale).where(User.telegram_id == user_id).execute()
+    session = get_user_session(user_id)
+    session['locale'] = locale
+    save_user_session(user_id, session)
 
-    if updated:
-        session_client.json_set(user_id, user_session)
 
-    return user_session
+def archive_cart(user_id, cart, last_active):
+    user = User.select(User.id).where(User.telegram_id == user_id).scalar()
+    if user is None:
+        return
+    product_ids = [product_id for product_id, in Product.select(
+        Product.id).where(Product.id << list(cart)).tuples()]
+    last_active = datetime.datetime.fromtimestamp(last_active) \
+        if last_active else datetime.datetime.now()
+    rows = [dict(user=user, product=product_id, count=cart[product_id],
+                 last_active=last_active)
+            for product_id in product_ids if cart[product_id] > 0]
+    if rows:
+        AbandonedCart.insert_many(rows).execute()
+
+
+def compact_sessions(idle_for, limit):
+    # carts left untouched for idle_for seconds are moved to the database,
+    # the rest of the session stays until it expires
+    idle_since = time.time() - idle_for
+    compacted = 0
+    for user_id in user_sessions.idle_user_ids(idle_since, limit):
+        if user_sessions.compact(user_id, idle_since, archive_cart):
+            compacted += 1
+    return compacted
 
 
 def get_courier_nickname(location):
@@ -391,18 +877,159 @@ def get_user_id(update):
     return user_id
 
 
-def get_config_session():
-    session = session_client.json_get('git_config')
+# Redis pub/sub fan-out of cache invalidations between bot processes,
+# messages look like "<name>:<version>"
+class InvalidationListener:
+    channel = 'shoppybot_invalidate'
 
-    if not session:
-        session_client.json_set('git_config', {})
-        session = session_client.json_get('git_config')
+    def __init__(self):
+        self.handlers = {}
+        self.thread = None
+
+    def register(self, name, handler):
+        self.handlers[name] = handler
+
+    def publish(self, name, version):
+        session_client.publish(self.channel, '{}:{}'.format(name, version))
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.listen, daemon=True,
+                                       name='invalidation-listener')
+        self.thread.start()
+
+    def listen(self):
+        while True:
+            pubsub = session_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                # messages could be missed while we were not subscribed
+                self.dispatch_all()
+                for message in pubsub.listen():
+                    name, sep, version = message['data'].decode(
+                        'utf-8').partition(':')
+                    handler = self.handlers.get(name)
+                    if handler:
+                        handler(version)
+            except redis.ConnectionError as e:
+                logger.error('Invalidation listener disconnected: %s', e)
+                time.sleep(1)
+            finally:
+                pubsub.close()
+
+    def dispatch_all(self):
+        for handler in self.handlers.values():
+            handler(None)
+
+
+# in-process copy of the config settings blob, reloaded only after
+# set_config_session bumped its version in any of the bot processes
+class ConfigSnapshot:
+    key = config_key('settings')
+    version_key = config_key('settings_version')
 
-    return session
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.session = None
+        self.version = None
+
+    def get(self):
+        session = self.session
+        if session is None:
+            with self.lock:
+                if self.session is None:
+                    self.reload()
+                session = self.session
+        return session
+
+    def reload(self):
+        # value and version read together, a missing value is left for
+        # set() to write
+        pipe = session_client.pipeline()
+        pipe.get(self.key)
+        pipe.get(self.version_key)
+        value, version = pipe.execute()
+        session = json.loads(value.decode('utf-8')) if value else {}
+        self.version = version.decode('utf-8') if version else '0'
+        self.session = session
+
+    def invalidate(self, version=None):
+        # waits for a reload in progress, so the version it read is the one
+        # compared and a newer one isn't lost
+        with self.lock:
+            if version is None or version != self.version:
+                self.session = None
+
+    def set(self, session):
+        pipe = session_client.pipeline()
+        pipe.set(self.key, json.dumps(session))
+        pipe.incr(self.version_key)
+        version = str(pipe.execute()[1])
+        self.invalidate()
+        invalidation_listener.publish('config', version)
+
+
+# telegram file_id of an uploaded image by its hash, per bot since file ids
+# can't be shared between bots
+def image_file_ids_key(bot):
+    return cache_key('image_file_ids:{}'.format(bot.id))
+
+
+def get_image_file_id(bot, image_hash):
+    value = session_client.hget(image_file_ids_key(bot), image_hash)
+    if value:
+        value = value.decode('utf-8')
+    return value
+
+
+def set_image_file_id(bot, image_hash, file_id):
+    session_client.hset(image_file_ids_key(bot), image_hash, file_id)
+
+
+# getChatMember results, shared between bot processes
+MEMBER_STATUS_TTL = 600
+NOT_MEMBER_STATUS_TTL = 60
+NOT_MEMBER_STATUSES = ('left', 'kicked')
+
+
+def member_status_key(chat_id, user_id):
+    return cache_key('chat_member:{}:{}'.format(chat_id, user_id))
+
+
+def get_cached_member_status(chat_id, user_id):
+    value = session_client.get(member_status_key(chat_id, user_id))
+    if value:
+        value = value.decode('utf-8')
+    return value
+
+
+def set_cached_member_status(chat_id, user_id, status):
+    if status in NOT_MEMBER_STATUSES:
+        ttl = NOT_MEMBER_STATUS_TTL
+    else:
+        ttl = MEMBER_STATUS_TTL
+    session_client.setex(member_status_key(chat_id, user_id), ttl, status)
+
+
+def get_config_snapshot():
+    # shared read-only dict, use get_config_session() to modify config
+    return config_snapshot.get()
+
+
+def get_config_session():
+    return dict(config_snapshot.get())
 
 
 def set_config_session(session):
-    session_client.json_set('git_config', session)
+    config_snapshot.set(session)
 
 
+logger = logging.getLogger(__name__)
 session_client = JsonRedis(host='localhost', port=6379, db=0)
+invalidation_listener = InvalidationListener()
+config_snapshot = ConfigSnapshot()
+invalidation_listener.register('config', config_snapshot.invalidate)
+catalog = CatalogIndex()
+invalidation_listener.register('catalog', catalog.invalidate)
+user_sessions = SessionStore()
@@ -0,0 +1,44 @@
+import hashlib
+import mmap
+import os
+import tempfile
+from contextlib import contextmanager
+from os.path import dirname, abspath, join
+
+
+# product images on disk, named by the sha256 of their content so the same
+# image is stored once and a changed image always gets a new name
+class ImageStore:
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, image_hash):
+        return join(self.root, image_hash[:2], image_hash)
+
+    def put(self, data):
+        image_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(image_hash)
+        if not os.path.exists(path):
+            os.makedirs(dirname(path), exist_ok=True)
+            # write aside and rename so readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return image_hash
+
+    @contextmanager
+    def open(self, image_hash):
+        with open(self.path(image_hash), 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+
+d = dirname(dirname(abspath(__file__)))
+image_store = ImageStore(join(d, 'images'))
@@ -1,56 +1,106 @@
+import json
 import os
+from functools import wraps
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, \
     KeyboardButton, ReplyKeyboardMarkup
 from .enums import *
 from .enums import _
+from .locales import translator
 
 
+# keyboards that only change with the language are built once per locale
+# and kept as the json telegram gets, bot methods send it as it is
+def cached_keyboard(func):
+    cache = {}
+
+    @wraps(func)
+    def wrapped(*args):
+        key = translator.get_locale(), args
+        markup = cache.get(key)
+        if markup is None:
+            markup = cache[key] = func(*args).to_json()
+        return markup
+    return wrapped
+
+
+# serialized keyboard with {{name}} placeholders, for keyboards where only a
+# label or a callback argument changes between sends
+class KeyboardTemplate:
+    def __init__(self, markup):
+        self.markup = markup.to_json()
+
+    def render(self, **values):
+        markup = self.markup
+        for name, value in values.items():
+            # escaped the way the rest of the json is
+            value = json.dumps(str(value))[1:-1]
+            markup = markup.replace('{{%s}}' % name, value)
+        return markup
+
+
+def cached_template(func):
+    cache = {}
+
+    @wraps(func)
+    def wrapped(*args):
+        key = translator.get_locale(), args
+        template = cache.get(key)
+        if template is None:
+            template = cache[key] = KeyboardTemplate(func(*args))
+        return template
+    return wrapped
+
+
+@cached_keyboard
 def create_time_keyboard():
     button_row = [
         [
-            KeyboardButton(BUTTON_TEXT_NOW)
+            KeyboardButton(_(BUTTON_TEXT_NOW))
         ],
         [
-            KeyboardButton(BUTTON_TEXT_SETTIME)
+            KeyboardButton(_(BUTTON_TEXT_SETTIME))
         ],
         [
-            KeyboardButton(BUTTON_TEXT_BACK),
-            KeyboardButton(BUTTON_TEXT_CANCEL)
+            KeyboardButton(_(BUTTON_TEXT_BACK)),
+            KeyboardButton(_(BUTTON_TEXT_CANCEL))
         ],
     ]
     return ReplyKeyboardMarkup(button_row, resize_keyboard=True)
 
 
+@cached_keyboard
 def create_confirmation_keyboard():
     button_row = [
-        [KeyboardButton(BUTTON_TEXT_CONFIRM)],
+        [KeyboardButton(_(BUTTON_TEXT_CONFIRM))],
         [
-            KeyboardButton(BUTTON_TEXT_BACK),
-            KeyboardButton(BUTTON_TEXT_CANCEL)
+            KeyboardButton(_(BUTTON_TEXT_BACK)),
+            KeyboardButton(_(BUTTON_TEXT_CANCEL))
         ]
     ]
     return ReplyKeyboardMarkup(button_row, resize_keyboard=True)
 
 
+@cached_keyboard
 def create_phone_number_request_keyboard():
     buttons = [
         [KeyboardButton(
             text=_('Allow to send my phone number'),
             request_contact=True
         )],
-        [KeyboardButton(BUTTON_TEXT_BACK)],
-        [KeyboardButton(BUTTON_TEXT_CANCEL)],
+        [KeyboardButton(_(BUTTON_TEXT_BACK))],
+        [KeyboardButton(_(BUTTON_TEXT_CANCEL))],
     ]
 
     return ReplyKeyboardMarkup(buttons, one_time_keyboard=True)
 
 
+@cached_keyboard
 def create_cancel_keyboard():
     button_row = [
         [
-            KeyboardButton(BUTTON_TEXT_BACK),
-            KeyboardButton(BUTTON_TEXT_CANCEL)
+            KeyboardButton(_(BUTTON_TEXT_BACK)),
+            KeyboardButton(_(BUTTON_TEXT_CANCEL))
         ],
     ]
     return ReplyKeyboardMarkup(button_row, resize_keyboard=True)
@@ -76,17 +126,18 @@ def create_pickup_location_keyboard(location_names):
 
     button_column.append(
         [
-            KeyboardButton(BUTTON_TEXT_BACK),
-            KeyboardButton(BUTTON_TEXT_CANCEL)
+            KeyboardButton(_(BUTTON_TEXT_BACK)),
+            KeyboardButton(_(BUTTON_TEXT_CANCEL))
         ])
     return ReplyKeyboardMarkup(button_column, resize_keyboard=True)
 
 
+@cached_keyboard
 def create_shipping_keyboard():
     button_row = [
-        [KeyboardButton(BUTTON_TEXT_PICKUP)],
-        [KeyboardButton(BUTTON_TEXT_DELIVERY)],
-        [KeyboardButton(BUTTON_TEXT_CANCEL)],
+        [KeyboardButton(_(BUTTON_TEXT_PICKUP))],
+        [KeyboardButton(_(BUTTON_TEXT_DELIVERY))],
+        [KeyboardButton(_(BUTTON_TEXT_CANCEL))],
     ]
     return ReplyKeyboardMarkup(button_row, resize_keyboard=True)
 
@@ -114,6 +165,7 @@ def create_courier_confirmation_keyboard(order_id, courier_name):
     return InlineKeyboardMarkup([buttons])
 
 
+@cached_keyboard
 def create_confirmation_inline_keyboard():
     buttons = [
         InlineKeyboardButton(_('Yes'),
@@ -130,21 +182,26 @@ def create_drop_responsibility_keyboard(user_id, courier_nickname, order_id):
                               url='https://t.me/{}'.format(courier_nickname))],
         [InlineKeyboardButton(_('Drop responsibility'),
                               callback_data='dropped|{}'.format(order_id))],
+        [InlineKeyboardButton(_('✅ Delivered'),
+                              callback_data='delivered|{}'.format(order_id))],
     ]
     return InlineKeyboardMarkup(buttons)
 
 
-def create_main_keyboard(review_channel, is_admin=None, total_price=0):
+@cached_template
+def create_main_keyboard_template(review_channel, is_admin):
     main_button_list = [
         [InlineKeyboardButton(_('🏪 Our products'),
                               callback_data='menu_products')],
-        [InlineKeyboardButton(_('🛍 Checkout {}').format(total_price),
+        [InlineKeyboardButton(_('🛍 Checkout {}').format('{{total}}'),
                               callback_data='menu_order')],
         [InlineKeyboardButton(_('⭐ Reviews'), url=review_channel)],
         [InlineKeyboardButton(_('⏰ Working hours'),
                               callback_data='menu_hours')],
         [InlineKeyboardButton(_('☎ Contact info'),
                               callback_data='menu_contact')],
+        [InlineKeyboardButton(_('🌐 Language'),
+                              callback_data='menu_language')],
     ]
     if is_admin:
         main_button_list.append(
@@ -153,40 +210,75 @@ def create_main_keyboard(review_channel, is_admin=None, total_price=0):
     return InlineKeyboardMarkup(main_button_list)
 
 
-<<<<<<< HEAD
-def create_bot_language_keyboard():
+def create_main_keyboard(review_channel, is_admin=None, total_price=0):
+    template = create_main_keyboard_template(review_channel, bool(is_admin))
+    return template.render(total=total_price)
+
+
+@cached_keyboard
+def create_bot_language_keyboard(prefix='lng_'):
     keyboard = [
         [InlineKeyboardButton(
-            _("Hebrew"), callback_data='lng_he')],
+            _("Hebrew"), callback_data=prefix + 'he')],
         [InlineKeyboardButton(
-            _("English"), callback_data='lng_en')]
+            _("English"), callback_data=prefix + 'en')]
     ]
     return InlineKeyboardMarkup(keyboard, resize_keyboard=True)
 
 
-=======
->>>>>>> f6538122448b694bf81e63a4b0db0fc00c966ff9
-def create_product_keyboard(product_id, user_data, cart):
+@cached_template
+def create_product_keyboard_template(in_cart):
     button_row = []
 
-    if cart.get_product_count(user_data, product_id) > 0:
+    if in_cart:
         button = InlineKeyboardButton(
-            _('➕ Add more'), callback_data='product_add|{}'.format(product_id))
+            _('➕ Add more'), callback_data='product_add|{{product_id}}')
         button_row.append(button)
     else:
         button = InlineKeyboardButton(
             _('🛍 Add to cart'),
-            callback_data='product_add|{}'.format(product_id))
+            callback_data='product_add|{{product_id}}')
         button_row.append(button)
 
-    if cart.get_product_count(user_data, product_id) > 0:
+    if in_cart:
         button = InlineKeyboardButton(
-            _('➖ Remove'), callback_data='product_remove|{}'.format(product_id))
+            _('➖ Remove'), callback_data='product_remove|{{product_id}}')
         button_row.append(button)
 
     return InlineKeyboardMarkup([button_row])
 
 
+def create_product_keyboard(product_id, user_data, cart):
+    in_cart = cart.get_product_count(user_data, product_id) > 0
+    template = create_product_keyboard_template(in_cart)
+    return template.render(product_id=product_id)
+
+
+def create_catalog_keyboard(products, page, pages, user_data, cart):
+    button_rows = []
+    for product in products:
+        button_row = [InlineKeyboardButton(
+            '➕ {}'.format(product.title),
+            callback_data='catalog_add|{}|{}'.format(product.id, page))]
+        if cart.get_product_count(user_data, product.id) > 0:
+            button_row.append(InlineKeyboardButton(
+                '➖', callback_data='catalog_remove|{}|{}'.format(
+                    product.id, page)))
+        button_rows.append(button_row)
+
+    nav_row = []
+    if page > 0:
+        nav_row.append(InlineKeyboardButton(
+            _('◀️ Back'), callback_data='catalog_page|{}'.format(page - 1)))
+    if page < pages - 1:
+        nav_row.append(InlineKeyboardButton(
+            _('Next ▶️'), callback_data='catalog_page|{}'.format(page + 1)))
+    if nav_row:
+        button_rows.append(nav_row)
+
+    return InlineKeyboardMarkup(button_rows)
+
+
 def create_bot_config_keyboard(session):
     button_row = [
         [InlineKeyboardButton(
@@ -198,6 +290,7 @@ def create_bot_config_keyboard(session):
     return InlineKeyboardMarkup(button_row, resize_keyboard=True)
 
 
+@cached_keyboard
 def create_admin_keyboard():
     main_button_list = [
         [InlineKeyboardButton(_('📈 Statistics'),
@@ -211,6 +304,7 @@ def create_admin_keyboard():
     return InlineKeyboardMarkup(main_button_list)
 
 
+@cached_keyboard
 def create_statistics_keyboard():
     main_button_list = [
         [InlineKeyboardButton(_('💵 Get statistics by all sells'),
@@ -232,6 +326,7 @@ def create_statistics_keyboard():
     return InlineKeyboardMarkup(main_button_list)
 
 
+@cached_keyboard
 def create_bot_settings_keyboard():
     main_button_list = [
         [InlineKeyboardButton(_('🛵 Couriers'),
@@ -248,6 +343,8 @@ def create_bot_settings_keyboard():
                               callback_data='bot_settings_edit_contact_info')],
         [InlineKeyboardButton(_('⚡️ Bot ON/OFF'),
                               callback_data='bot_settings_bot_on_off')],
+        [InlineKeyboardButton(_('🌐 Language'),
+                              callback_data='bot_settings_language')],
         [InlineKeyboardButton(_('💫 Reset all data'),
                               callback_data='bot_settings_reset_all_data')],
         [InlineKeyboardButton(_('↩ Back'),
@@ -257,6 +354,7 @@ def create_bot_settings_keyboard():
     return InlineKeyboardMarkup(main_button_list)
 
 
+@cached_keyboard
 def create_bot_couriers_keyboard():
     main_button_list = [
         [InlineKeyboardButton(_('🛵 View couriers'),
@@ -272,6 +370,7 @@ def create_bot_couriers_keyboard():
     return InlineKeyboardMarkup(main_button_list)
 
 
+@cached_keyboard
 def create_bot_channels_keyboard():
     main_button_list = [
         [InlineKeyboardButton(_('✉️ View channels'),
@@ -287,6 +386,7 @@ def create_bot_channels_keyboard():
     return InlineKeyboardMarkup(main_button_list)
 
 
+@cached_keyboard
 def create_bot_locations_keyboard():
     main_button_list = [
         [InlineKeyboardButton(_('🎯️ View locations'),
@@ -302,6 +402,7 @@ def create_bot_locations_keyboard():
     return InlineKeyboardMarkup(main_button_list)
 
 
+@cached_keyboard
 def create_bot_order_options_keyboard():
     main_button_list = [
         [InlineKeyboardButton(_('➕️ Add new product'),
@@ -331,20 +432,23 @@ def create_bot_order_options_keyboard():
     return InlineKeyboardMarkup(main_button_list)
 
 
+@cached_keyboard
 def create_back_button():
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton(BUTTON_TEXT_CANCEL, callback_data='back')]
+        [InlineKeyboardButton(_(BUTTON_TEXT_CANCEL), callback_data='back')]
     ])
 
 
+@cached_keyboard
 def create_on_off_buttons():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton('ON', callback_data='on')],
         [InlineKeyboardButton('OFF', callback_data='off')],
-        [InlineKeyboardButton(BUTTON_TEXT_CANCEL, callback_data='back')],
+        [InlineKeyboardButton(_(BUTTON_TEXT_CANCEL), callback_data='back')],
     ])
 
 
+@cached_keyboard
 def create_ban_list_keyboard():
     main_button_list = [
         [InlineKeyboardButton(_('🔥 View ban list'),
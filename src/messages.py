@@ -1,156 +1,197 @@
+from string import Formatter
+
 from src.enums import _
+from src.locales import translator
+
+SEPARATOR = '〰️'
+LONG_SEPARATOR = '〰〰〰〰〰〰〰〰〰〰〰〰️'
+
+
+# a translatable format string, split once per locale into its static text
+# and the fields filled in when rendering
+class Fragment:
+    def __init__(self, message):
+        self.message = message
+        self.compiled = {}
+
+    def compile(self, locale):
+        parts = []
+        index = 0
+        text = translator.gettext(self.message, locale)
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if literal:
+                parts.append(literal)
+            if field is not None:
+                if field == '':
+                    field = index
+                    index += 1
+                parts.append((int(field), spec or ''))
+        return tuple(parts)
+
+    def get_parts(self):
+        locale = translator.get_locale()
+        parts = self.compiled.get(locale)
+        if parts is None:
+            parts = self.compiled[locale] = self.compile(locale)
+        return parts
+
+    def write(self, out, *args):
+        for part in self.get_parts():
+            if isinstance(part, str):
+                out.append(part)
+            else:
+                index, spec = part
+                out.append(format(args[index], spec))
+
+
+PRODUCT = Fragment('Product:\n{}')
+DELIVERY_FEE = Fragment('<b>Delivery Fee: {}$</b>')
+DELIVERY_MIN = Fragment('for orders below {}$')
+PRICE = Fragment('Price:')
+PRICE_TIER = Fragment('x {} = ${}')
+COUNT = Fragment('Count: <b>{}</b>')
+SUBTOTAL = Fragment('Subtotal: <b>${}</b>')
+OUR_PRODUCTS = Fragment('Our products:')
+TOTAL = Fragment('Total: <b>${}</b>')
+ITEMS_IN_CART = Fragment('Items in cart:')
+CONFIRM_ORDER = Fragment('<b>Please confirm your order:</b>')
+ORDER_NOTICE = Fragment('<b>Order №{} notice:</b>')
+SHIPPING_DETAILS = Fragment('Shipping details:')
+VIP_CUSTOMER = Fragment('Vip Costumer')
+
+# shipping details in the order they are listed, values of translated ones
+# are stored untranslated
+SHIPPING_FIELDS = (
+    ('photo_question', Fragment('Photo question: '), False),
+    ('method', Fragment('Pickup/Delivery: '), True),
+    ('pickup_location', Fragment('Pickup location: '), False),
+    ('address', Fragment('Address: '), False),
+    ('time', Fragment('When: '), True),
+    ('time_text', Fragment('Time: '), False),
+    ('phone_number', Fragment('Phone number: '), False),
+)
+
+
+def write_delivery_fee(out, delivery_min, delivery_fee):
+    DELIVERY_FEE.write(out, delivery_fee)
+    out.append('\n')
+    DELIVERY_MIN.write(out, delivery_min)
+    out.append('\n')
+
+
+def write_count(out, product_count, subtotal):
+    COUNT.write(out, product_count)
+    out.append('\n')
+    SUBTOTAL.write(out, int(subtotal))
 
 
 def create_product_description(product_title, product_prices, product_count,
                                subtotal, delivery_min, delivery_fee):
-    text = _('Product:\n{}').format(product_title)
-    text += '\n\n'
-    text += '〰️'
-    text += '\n'
+    out = []
+    PRODUCT.write(out, product_title)
+    out.append('\n\n' + SEPARATOR + '\n')
     if delivery_fee > 0:
-        text += _('<b>Delivery Fee: {}$</b>').format(delivery_fee)
-        text += '\n'
-        text += _('for orders below {}$').format(delivery_min)
-        text += '\n'
-        text += '〰️'
-    text += '\n'
-    text += _('Price:')
-    text += '\n'
+        write_delivery_fee(out, delivery_min, delivery_fee)
+        out.append(SEPARATOR)
+    out.append('\n')
+    PRICE.write(out)
+    out.append('\n')
 
     for q, price in product_prices:
-        text += '\n'
-        text += _('x {} = ${}').format(q, int(price))
-
-    q = product_count
-    if q > 0:
-        text += '\n\n〰️\n\n'
-        text += _('Count: <b>{}</b>').format(q)
-        text += '\n'
-        text += _('Subtotal: <b>${}</b>').format(int(subtotal))
-        text += '\n'
+        out.append('\n')
+        PRICE_TIER.write(out, q, int(price))
 
-    return text
+    if product_count > 0:
+        out.append('\n\n' + SEPARATOR + '\n\n')
+        write_count(out, product_count, subtotal)
+        out.append('\n')
 
+    return ''.join(out)
 
-def create_confirmation_text(is_pickup, shipping_data, total, delivery_min, delivery_cost,
-                             product_info):
 
-    text = _('<b>Please confirm your order:</b>')
-    text += '\n\n'
-    text += '〰〰〰〰〰〰〰〰〰〰〰〰️'
-    text += '\n'
-    text += _('Items in cart:')
-    text += '\n'
+def create_catalog_description(products_info, delivery_min, delivery_fee,
+                               page, pages):
+    out = []
+    OUR_PRODUCTS.write(out)
+    if pages > 1:
+        out.append(' {}/{}'.format(page + 1, pages))
+    out.append('\n')
+    if delivery_fee > 0:
+        out.append(SEPARATOR + '\n')
+        write_delivery_fee(out, delivery_min, delivery_fee)
+
+    for product_title, product_prices, product_count, subtotal in \
+            products_info:
+        out.append('\n' + SEPARATOR + '\n<b>')
+        out.append(product_title)
+        out.append('</b>\n')
+        for i, (q, price) in enumerate(product_prices):
+            if i:
+                out.append(', ')
+            PRICE_TIER.write(out, q, int(price))
+        if product_count > 0:
+            out.append('\n')
+            write_count(out, product_count, subtotal)
+        out.append('\n')
+
+    return ''.join(out)
+
+
+def write_order(out, is_pickup, product_info, shipping_data, total,
+                delivery_min, delivery_cost, items_separator):
+    # items and total, shared by the customer confirmation and the notice
+    out.append('\n\n' + LONG_SEPARATOR + '\n')
+    ITEMS_IN_CART.write(out)
+    out.append('\n')
 
     for title, product_count, price in product_info:
-        text += '\n'
-        text += _('Product:\n{}').format(title)
-        text += '\n'
-        text += _('x {} = ${}').format(product_count, price, )
-        text += '\n'
-    text += '〰〰〰〰〰〰〰〰〰〰〰〰️'
-
-    is_vip = False
-    for key, value in shipping_data.items():
-        if key == 'vip':
-            is_vip = True
-
-    if total < delivery_cost:
-        if is_pickup:
-            text += '\n\n'
-            text += _('Total: <b>${}</b>').format(total)
-        else:
-            if is_vip:
-                text += '\n\n'
-                text += _('Total: <b>${}</b>').format(total)
-            else:
-                text += '\n\n'
-                text += _('<b>Delivery Fee: {}$</b>').format(delivery_cost)
-                text += '\n'
-                text += _('Total: <b>${}</b>').format(total + delivery_cost)
+        out.append('\n')
+        PRODUCT.write(out, title)
+        out.append('\n')
+        PRICE_TIER.write(out, product_count, price)
+        out.append('\n')
+    if items_separator:
+        out.append(LONG_SEPARATOR)
+
+    out.append('\n\n')
+    pays_delivery = total < delivery_min and not is_pickup \
+        and 'vip' not in shipping_data
+    if pays_delivery:
+        DELIVERY_FEE.write(out, delivery_cost)
+        out.append('\n')
+        TOTAL.write(out, total + delivery_cost)
     else:
-        text += '\n\n'
-        text += _('Total: <b>${}</b>').format(total)
+        TOTAL.write(out, total)
+
 
-    return text
+def create_confirmation_text(is_pickup, shipping_data, total, delivery_min,
+                             delivery_cost, product_info):
+    out = []
+    CONFIRM_ORDER.write(out)
+    write_order(out, is_pickup, product_info, shipping_data, total,
+                delivery_min, delivery_cost, items_separator=True)
+    return ''.join(out)
 
 
 def create_service_notice(is_pickup, order_id, product_info, shipping_data,
                           total, delivery_min, delivery_cost):
-
-    text = _('<b>Order №{} notice:</b>'.format(order_id))
-    text += '\n\n'
-    text += '〰〰〰〰〰〰〰〰〰〰〰〰️'
-    text += '\n'
-    text += _('Items in cart:')
-    text += '\n'
-
-    for title, product_count, price in product_info:
-        text += '\n'
-        text += _('Product:\n{}').format(title)
-        text += '\n'
-        text += _('x {} = ${}').format(product_count, price, )
-        text += '\n'
-
-    is_vip = False
-    for key, value in shipping_data.items():
-        if key == 'vip':
-            is_vip = True
-
-    if total < delivery_min:
-        if is_pickup:
-            text += '\n\n'
-            text += _('Total: <b>${}</b>').format(total)
-        else:
-            if is_vip:
-                text += '\n\n'
-                text += _('Total: <b>${}</b>').format(total)
-            else:
-                text += '\n\n'
-                text += _('<b>Delivery Fee: {}$</b>').format(delivery_cost)
-                text += '\n'
-                text += _('Total: <b>${}</b>').format(total + delivery_cost)
-    else:
-        text += '\n\n'
-        text += _('Total: <b>${}</b>').format(total)
-    text += '\n'
-    text += '〰〰〰〰〰〰〰〰〰〰〰〰️'
-
-    text += '\n\n'
-    text += _('Shipping details:')
-    text += '\n\n'
-
-    for key, value in shipping_data.items():
-        if key == 'vip':
-            text += _('Vip Costumer')
-            text += '\n'
-        if key == 'photo_question':
-            text += _('Photo question: ')
-            text += value
-            text += '\n'
-        if key == 'method':
-            text += _('Pickup/Delivery: ')
-            text += value
-            text += '\n'
-        if key == 'pickup_location':
-            text += _('Pickup location: ')
-            text += value
-            text += '\n'
-        if key == 'address':
-            text += _('Address: ')
-            text += value
-            text += '\n'
-        if key == 'time':
-            text += _('When: ')
-            text += value
-            text += '\n'
-        if key == 'time_text':
-            text += _('Time: ')
-            text += value
-            text += '\n'
-        if key == 'phone_number':
-            text += _('Phone number: ')
-            text += value
-            text += '\n'
-
-    return text
+    out = []
+    ORDER_NOTICE.write(out, order_id)
+    write_order(out, is_pickup, product_info, shipping_data, total,
+                delivery_min, delivery_cost, items_separator=False)
+    out.append('\n' + LONG_SEPARATOR + '\n\n')
+    SHIPPING_DETAILS.write(out)
+    out.append('\n\n')
+
+    if 'vip' in shipping_data:
+        VIP_CUSTOMER.write(out)
+        out.append('\n')
+    for key, label, is_translated in SHIPPING_FIELDS:
+        value = shipping_data.get(key)
+        if value is None:
+            continue
+        label.write(out)
+        out.append(_(value) if is_translated else value)
+        out.append('\n')
+
+    return ''.join(out)
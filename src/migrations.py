@@ -0,0 +1,199 @@
+import logging
+
+import datetime
+
+import redis
+from peewee import fn, CharField, DateTimeField, IntegerField, SQL
+from playhouse.migrate import SchemaMigrator, migrate
+
+from .helpers import session_client, user_sessions, session_key, \
+    config_key, cache_key, orders_key
+from .images import image_store
+from .models import db, connection, MODELS, SchemaVersion, Product, \
+    Order, OrderEvent, OrderStatus, DailySales
+from .statistics import rebuild_daily_sales
+
+logger = logging.getLogger(__name__)
+
+
+#
+# schema migrations, append new ones to MIGRATIONS with the next version,
+# fresh databases are created from the models and skip all of them
+#
+
+def add_lookup_indexes(migrator):
+    migrate(
+        migrator.add_index('user', ('telegram_id',), True),
+        migrator.add_index('courier', ('telegram_id',), True),
+        migrator.add_index('location', ('title',), True),
+        migrator.add_index('order', ('confirmed',), False),
+        migrator.add_index('order', ('date_created',), False),
+        migrator.add_index('productcount', ('product_id', 'count'), True),
+    )
+
+
+def move_product_images(migrator):
+    migrate(migrator.add_column('product', 'image_hash',
+                                CharField(max_length=64, null=True)))
+    cursor = db.execute_sql(
+        'SELECT id, image FROM product WHERE image IS NOT NULL')
+    for product_id, image in cursor.fetchall():
+        image_hash = image_store.put(bytes(image))
+        Product.update(image_hash=image_hash).where(
+            Product.id == product_id).execute()
+    migrate(migrator.drop_column('product', 'image'))
+
+
+def add_user_locale(migrator):
+    # older databases were created before the model had the column
+    for table in ('user', 'courier'):
+        columns = [column.name for column in db.get_columns(table)]
+        if 'locale' not in columns:
+            migrate(migrator.add_column(
+                table, 'locale', CharField(max_length=4, null=True)))
+
+
+def add_order_status(migrator):
+    migrate(
+        migrator.add_column('order', 'status', IntegerField(
+            default=OrderStatus.CREATED.value)),
+        migrator.add_column('order', 'status_updated',
+                            DateTimeField(null=True)),
+    )
+    Order.update(status=OrderStatus.CONFIRMED.value).where(
+        SQL('confirmed')).execute()
+    Order.update(status=OrderStatus.CLAIMED.value).where(
+        Order.status == OrderStatus.CREATED.value,
+        ~(Order.courier >> None)).execute()
+    # the rest stay CREATED where the sweeper doesn't look, they have no
+    # saved offer to repeat and must not be expired years later
+    Order.update(status_updated=Order.date_created).execute()
+    Order.update(status_updated=datetime.datetime.now()).where(
+        Order.status_updated >> None).execute()
+    # history starts with the status each order has now
+    OrderEvent.insert_from(
+        fields=[OrderEvent.order, OrderEvent.status, OrderEvent.courier,
+                OrderEvent.created],
+        query=Order.select(Order.id, Order.status, Order.courier,
+                           Order.status_updated)).execute()
+
+    indexes = [index.name for index in db.get_indexes('order')]
+    operations = []
+    if 'order_confirmed' in indexes:
+        operations.append(migrator.drop_index('order', 'order_confirmed'))
+    operations += [
+        migrator.drop_column('order', 'confirmed'),
+        migrator.add_not_null('order', 'status_updated'),
+        migrator.add_index('order', ('status', 'status_updated'), False),
+    ]
+    migrate(*operations)
+
+
+def rebuild_daily_sales_table(migrator):
+    # the rollup is made from the orders, rebuilt with its new unique key and
+    # filled so yearly and monthly stats show the sales made so far
+    DailySales.drop_table(fail_silently=True)
+    DailySales.create_table()
+    rebuild_daily_sales()
+
+
+MIGRATIONS = [
+    (1, add_lookup_indexes),
+    (2, move_product_images),
+    (3, add_user_locale),
+    (4, add_order_status),
+    (5, rebuild_daily_sales_table),
+]
+
+
+def get_schema_version():
+    return SchemaVersion.select(fn.MAX(SchemaVersion.version)).scalar() or 0
+
+
+def create_tables():
+    with connection():
+        migrate_schema()
+
+
+def migrate_schema():
+    is_new = 'product' not in db.get_tables()
+    # creates tables added since the database was made, existing are kept
+    db.create_tables(MODELS, safe=True)
+
+    if is_new:
+        with db.atomic():
+            for version, migration in MIGRATIONS:
+                SchemaVersion.create(version=version)
+        return
+
+    current_version = get_schema_version()
+    migrator = SchemaMigrator.from_database(db.obj)
+    for version, migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        logger.info('Applying schema migration %s (%s)',
+                    version, migration.__name__)
+        with db.atomic():
+            migration(migrator)
+            SchemaVersion.create(version=version)
+
+
+#
+# redis keys made before they were kept in namespaces, moved once
+#
+
+KEYSPACE_VERSION_KEY = config_key('keyspace_version')
+# bumped when more keys get a namespace so the scan runs once more
+KEYSPACE_VERSION = 2
+
+RENAMED_KEYS = {
+    'git_config': config_key('settings'),
+    'git_config_version': config_key('settings_version'),
+    'catalog_version': cache_key('catalog_version'),
+    'couriers_version': cache_key('couriers_version'),
+    # the consumer group moves along with the stream
+    'order_events': orders_key('events'),
+    'order_events_dead': orders_key('events_dead'),
+}
+
+CACHE_KEY_PREFIXES = ('image_file_ids:', 'chat_member:', 'order_offers:',
+                      'order_offer:')
+
+ORDERS_KEY_PREFIX = 'order_events_done:'
+
+
+def get_namespaced_key(key):
+    if key.isdigit():
+        return session_key(key)
+    if key.startswith(CACHE_KEY_PREFIXES):
+        return cache_key(key)
+    if key.startswith(ORDERS_KEY_PREFIX):
+        return orders_key('events_done:' + key[len(ORDERS_KEY_PREFIX):])
+    return RENAMED_KEYS.get(key)
+
+
+def migrate_keyspace():
+    if int(session_client.get(KEYSPACE_VERSION_KEY) or 0) >= KEYSPACE_VERSION:
+        return
+    moved = 0
+    for key in session_client.scan_iter(count=1000):
+        key = key.decode('utf-8')
+        new_key = get_namespaced_key(key)
+        if new_key is None:
+            continue
+        try:
+            if not session_client.renamenx(key, new_key):
+                # left for a look, nothing is merged or thrown away
+                logger.warning('Redis key %s kept, %s already exists',
+                               key, new_key)
+                continue
+        except redis.ResponseError:
+            # moved by another process meanwhile
+            continue
+        if key.isdigit():
+            # converts json sessions and gives them the idle ttl
+            user_sessions.load(int(key))
+        moved += 1
+    session_client.set(KEYSPACE_VERSION_KEY, KEYSPACE_VERSION)
+    if moved:
+        logger.info('Moved %s redis keys to their namespaces', moved)
@@ -1,11 +1,54 @@
 import datetime
-from os.path import dirname, abspath
+from contextlib import contextmanager
+from os.path import dirname, abspath, join
 from enum import Enum
 from peewee import Model, CharField, IntegerField, SqliteDatabase, \
-    ForeignKeyField, DecimalField, BlobField, BooleanField, DateField
+    ForeignKeyField, DecimalField, BooleanField, DateField, \
+    DateTimeField, Proxy
+from playhouse.db_url import connect
 
 d = dirname(dirname(abspath(__file__)))
-db = SqliteDatabase(join(d, 'db.sqlite'))
+DEFAULT_DATABASE_URL = 'sqlite:///' + join(d, 'db.sqlite')
+# lets several readers work next to the single writer
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('busy_timeout', 5000),
+)
+# the actual database is picked from the config by init_database
+db = Proxy()
+
+
+def create_database(url):
+    url = url or DEFAULT_DATABASE_URL
+    if url.startswith('sqlite'):
+        return connect(url, pragmas=SQLITE_PRAGMAS)
+    # postgres+pool:// and mysql+pool:// urls give a pooled database,
+    # pool size and timeouts go in the query string, e.g.
+    # ?max_connections=8&stale_timeout=300
+    return connect(url)
+
+
+def init_database(url=None):
+    db.initialize(create_database(url))
+    return db.obj
+
+
+@contextmanager
+def connection():
+    # a connection is checked out for one unit of work and given back to the
+    # pool when it is done, nested units share the outer one
+    opened = db.is_closed()
+    if opened:
+        db.connect()
+    try:
+        yield
+    finally:
+        if opened:
+            db.close()
+
+
+init_database()
 
 
 class DeliveryMethod(Enum):
@@ -13,19 +56,38 @@ class DeliveryMethod(Enum):
     DELIVERY = 2
 
 
+class OrderStatus(Enum):
+    CREATED = 1
+    OFFERED = 2
+    CLAIMED = 3
+    CONFIRMED = 4
+    DELIVERED = 5
+    CANCELLED = 6
+
+
+# orders counted as sales
+SOLD_STATUSES = (OrderStatus.CONFIRMED.value, OrderStatus.DELIVERED.value)
+
+
 class BaseModel(Model):
     class Meta:
         database = db
 
 
+class SchemaVersion(BaseModel):
+    version = IntegerField(primary_key=True)
+    applied = DateTimeField(default=datetime.datetime.now)
+
+
 class Location(BaseModel):
-    title = CharField()
+    title = CharField(unique=True)
 
 
 class User(BaseModel):
     username = CharField(null=True)
-    telegram_id = IntegerField()
-    locale = CharField(max_length=4)
+    telegram_id = IntegerField(unique=True)
+    # empty until the user picks a language, the default one is used
+    locale = CharField(max_length=4, null=True)
     phone_number = CharField(null=True)
 
     # def save(self, force_insert=False, only=None):
@@ -45,7 +107,8 @@ class CourierLocation(BaseModel):
 
 class Product(BaseModel):
     title = CharField()
-    image = BlobField(null=True)
+    # sha256 of the image in the image store
+    image_hash = CharField(max_length=64, null=True)
     is_active = BooleanField(default=True)
 
 
@@ -54,6 +117,11 @@ class ProductCount(BaseModel):
     count = IntegerField()
     price = DecimalField()
 
+    class Meta:
+        indexes = (
+            (('product', 'count'), True),
+        )
+
 
 class Order(BaseModel):
     user = ForeignKeyField(User, related_name='user_orders')
@@ -62,8 +130,16 @@ class Order(BaseModel):
                                    choices=DeliveryMethod)
     shipping_time = CharField(null=True)
     location = ForeignKeyField(Location, null=True)
-    confirmed = BooleanField(default=False)
-    date_created = DateField(default=datetime.datetime.now, null=True)
+    status = IntegerField(default=OrderStatus.CREATED.value,
+                          choices=OrderStatus)
+    status_updated = DateTimeField(default=datetime.datetime.now)
+    date_created = DateField(default=datetime.datetime.now, null=True,
+                             index=True)
+
+    class Meta:
+        indexes = (
+            (('status', 'status_updated'), False),
+        )
 
 
 class OrderItem(BaseModel):
@@ -74,11 +150,44 @@ class OrderItem(BaseModel):
                                verbose_name='total price for each item')
 
 
-def create_tables():
-    db.connect()
-    db.create_tables(
-        [
-            Location, CourierLocation, User, Courier, Product, ProductCount,
-            Order, OrderItem
-        ], safe=True
-    )
+# every status an order went through, never updated
+class OrderEvent(BaseModel):
+    order = ForeignKeyField(Order, related_name='events')
+    status = IntegerField(choices=OrderStatus)
+    courier = ForeignKeyField(User, related_name='courier_events', null=True)
+    created = DateTimeField(default=datetime.datetime.now)
+
+
+# carts of users who left without ordering, moved here from idle sessions
+class AbandonedCart(BaseModel):
+    user = ForeignKeyField(User, related_name='abandoned_carts')
+    product = ForeignKeyField(Product, related_name='abandoned_items')
+    count = IntegerField()
+    last_active = DateTimeField()
+    archived = DateTimeField(default=datetime.datetime.now, index=True)
+
+
+# confirmed sales per day, rows with an empty product hold order totals
+class DailySales(BaseModel):
+    # date, location, courier and product in one value, a unique index over
+    # the nullable columns would let duplicate total rows in
+    key = CharField(unique=True)
+    date = DateField()
+    location = ForeignKeyField(Location, null=True)
+    courier = ForeignKeyField(User, related_name='courier_sales', null=True)
+    product = ForeignKeyField(Product, related_name='product_sales',
+                              null=True)
+    orders = IntegerField(default=0)
+    items = IntegerField(default=0)
+    revenue = DecimalField(default=0)
+
+    class Meta:
+        indexes = (
+            (('date', 'product'), False),
+        )
+
+
+MODELS = [
+    SchemaVersion, Location, CourierLocation, User, Courier, Product,
+    ProductCount, Order, OrderItem, OrderEvent, DailySales, AbandonedCart
+]
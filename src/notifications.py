@@ -0,0 +1,165 @@
+import logging
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, \
+    TelegramError
+
+from .models import connection
+
+logger = logging.getLogger(__name__)
+
+
+# runs jobs on a bounded thread pool, jobs sharing a key run one after
+# another in the order they were submitted
+class KeyedExecutor:
+    def __init__(self, max_workers=4):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+        self.queues = {}
+
+    def submit(self, key, fn, *args, **kwargs):
+        with self.lock:
+            queue = self.queues.get(key)
+            is_idle = queue is None
+            if is_idle:
+                queue = self.queues[key] = deque()
+            queue.append((fn, args, kwargs))
+        if is_idle:
+            self.pool.submit(self.run_next, key)
+
+    def run_next(self, key):
+        with self.lock:
+            fn, args, kwargs = self.queues[key].popleft()
+        try:
+            with connection():
+                fn(*args, **kwargs)
+        except Exception:
+            logger.exception('Job for %s failed', key)
+        with self.lock:
+            if not self.queues[key]:
+                del self.queues[key]
+                return
+        # requeue instead of looping so that one busy key can't hold a worker
+        self.pool.submit(self.run_next, key)
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+
+# sends telegram messages in the background, messages to the same chat keep
+# their order, failed sends are retried without blocking the caller
+class NotificationDispatcher:
+    def __init__(self, max_workers=4, retries=3, retry_delay=1):
+        self.executor = KeyedExecutor(max_workers)
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def send(self, bot, chat_id, method, **kwargs):
+        self.executor.submit(chat_id, self.call, bot, chat_id, method, kwargs)
+
+    def call(self, bot, chat_id, method, kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                return getattr(bot, method)(chat_id, **kwargs)
+            except BadRequest as e:
+                # retrying the same request won't help
+                logger.error('%s to %s rejected: %s', method, chat_id, e)
+                return
+            except RetryAfter as e:
+                delay = e.retry_after
+            except NetworkError as e:
+                logger.warning('%s to %s failed: %s', method, chat_id, e)
+                delay = self.retry_delay * 2 ** attempt
+            except TelegramError as e:
+                logger.error('%s to %s failed: %s', method, chat_id, e)
+                return
+            time.sleep(delay)
+        logger.error('%s to %s dropped after %s retries',
+                     method, chat_id, self.retries)
+
+
+notifications = NotificationDispatcher()
+
+
+# edits of one message sent after a quiet window, only the latest content
+# goes out and content the message already shows is not sent again
+class DebouncedEditor:
+    def __init__(self, delay=0.4, max_messages=10000, max_workers=4):
+        self.delay = delay
+        self.max_messages = max_messages
+        self.condition = threading.Condition()
+        # (chat id, message id): (due time, bot, text, markup, kwargs)
+        self.pending = {}
+        self.shown = OrderedDict()
+        # edits of one message go out one after another in order
+        self.executor = KeyedExecutor(max_workers)
+        self.thread = None
+
+    def edit(self, bot, chat_id, message_id, text, reply_markup=None,
+             **kwargs):
+        key = chat_id, message_id
+        with self.condition:
+            self.pending[key] = (time.monotonic() + self.delay, bot, text,
+                                 reply_markup, kwargs)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True,
+                                               name='debounced-editor')
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        # a single thread hands the edits that are due to the executor
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                for key in [key for key, (due, *edit) in self.pending.items()
+                            if due <= now]:
+                    due, *edit = self.pending.pop(key)
+                    self.executor.submit(key, self.flush, key, *edit)
+                if self.pending:
+                    self.condition.wait(
+                        min(due for due, *edit in self.pending.values()) - now)
+                else:
+                    self.condition.wait()
+
+    def get_content(self, text, reply_markup):
+        if reply_markup is not None and not isinstance(reply_markup, str):
+            reply_markup = reply_markup.to_json()
+        return text, reply_markup
+
+    def remember(self, chat_id, message_id, text, reply_markup=None):
+        key = chat_id, message_id
+        with self.condition:
+            self.shown[key] = self.get_content(text, reply_markup)
+            self.shown.move_to_end(key)
+            while len(self.shown) > self.max_messages:
+                self.shown.popitem(last=False)
+
+    def flush(self, key, bot, text, reply_markup, kwargs):
+        content = self.get_content(text, reply_markup)
+        with self.condition:
+            if key in self.pending:
+                # a newer edit is scheduled
+                return
+            if self.shown.get(key) == content:
+                return
+        chat_id, message_id = key
+        try:
+            bot.edit_message_text(chat_id=chat_id, message_id=message_id,
+                                  text=text, reply_markup=reply_markup,
+                                  **kwargs)
+        except BadRequest as e:
+            if 'not modified' not in str(e):
+                logger.error('Edit of %s in %s failed: %s',
+                             message_id, chat_id, e)
+                return
+        except TelegramError as e:
+            logger.error('Edit of %s in %s failed: %s', message_id, chat_id, e)
+            return
+        self.remember(chat_id, message_id, text, reply_markup)
+
+
+card_editor = DebouncedEditor()
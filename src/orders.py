@@ -0,0 +1,228 @@
+import datetime
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+import redis
+from peewee import fn
+
+from .helpers import session_client, orders_key
+from .models import Order, OrderEvent, OrderStatus, connection, db
+
+logger = logging.getLogger(__name__)
+
+
+# statuses an order can move to from each status
+TRANSITIONS = {
+    OrderStatus.CREATED: (OrderStatus.OFFERED, OrderStatus.CANCELLED),
+    OrderStatus.OFFERED: (OrderStatus.CLAIMED, OrderStatus.CANCELLED),
+    OrderStatus.CLAIMED: (OrderStatus.OFFERED, OrderStatus.CONFIRMED,
+                          OrderStatus.CANCELLED),
+    OrderStatus.CONFIRMED: (OrderStatus.DELIVERED, OrderStatus.CANCELLED),
+    OrderStatus.DELIVERED: (),
+    OrderStatus.CANCELLED: (),
+}
+
+
+def create_order(**fields):
+    # call inside a transaction together with filling the order
+    now = datetime.datetime.now()
+    order = Order.create(status=OrderStatus.CREATED.value,
+                         status_updated=now, **fields)
+    OrderEvent.create(order=order.id, status=OrderStatus.CREATED.value,
+                      created=now)
+    return order
+
+
+def transition_order(order_id, status, *conditions, **changes):
+    # a single conditional update, False if the order wasn't in a status
+    # leading to this one or the conditions didn't hold, e.g. someone was
+    # quicker
+    previous = [from_status.value for from_status, to_statuses
+                in TRANSITIONS.items() if status in to_statuses]
+    now = datetime.datetime.now()
+    with db.atomic():
+        updated = Order.update(
+            status=status.value, status_updated=now, **changes
+        ).where(Order.id == order_id, Order.status << previous,
+                *conditions).execute()
+        if updated:
+            OrderEvent.create(order=order_id, status=status.value,
+                              courier=changes.get('courier'), created=now)
+    return updated == 1
+
+
+def get_stale_orders(status, updated_before, limit):
+    # [(order id, when it got the status)] of the orders longest in status
+    # without a change, goes by the (status, status_updated) index
+    order_ids = [order_id for order_id, in Order.select(Order.id).where(
+        Order.status == status.value,
+        Order.status_updated < updated_before
+    ).order_by(Order.status_updated.asc()).limit(limit).tuples()]
+    if not order_ids:
+        return []
+    entered = dict(OrderEvent.select(
+        OrderEvent.order, fn.MAX(OrderEvent.created)
+    ).where(OrderEvent.order << order_ids,
+            OrderEvent.status == status.value
+            ).group_by(OrderEvent.order).tuples())
+    return [(order_id, entered.get(order_id)) for order_id in order_ids]
+
+
+def touch_order(order_id, status):
+    # moves the order to the back of the sweep queue without a transition
+    return Order.update(status_updated=datetime.datetime.now()).where(
+        Order.id == order_id, Order.status == status.value).execute() == 1
+
+
+def decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def decode_fields(fields):
+    return dict(zip(map(decode, fields[::2]), map(decode, fields[1::2])))
+
+
+# "order confirmed" events on a redis stream, a consumer group handles them
+# at least once: entries are acked only after the handler succeeded, entries
+# left pending by a dead consumer are claimed again, entries failing too
+# often go to the dead letter list
+class OrderEventStream:
+    def __init__(self, client, stream=orders_key('events'),
+                 group='channel_posts', dead_letter=orders_key('events_dead'),
+                 batch_size=10,
+                 block=5000, claim_idle=60000, max_deliveries=5):
+        self.client = client
+        self.stream = stream
+        self.group = group
+        self.dead_letter = dead_letter
+        self.batch_size = batch_size
+        self.block = block
+        self.claim_idle = claim_idle
+        self.max_deliveries = max_deliveries
+        self.consumer = '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.handler = None
+
+    def publish(self, event):
+        return self.client.execute_command(
+            'XADD', self.stream, '*', 'event', json.dumps(event))
+
+    def done_key(self, order_id):
+        return orders_key('events_done:{}'.format(order_id))
+
+    def is_done(self, order_id, step):
+        return self.client.hexists(self.done_key(order_id), step)
+
+    def set_done(self, order_id, step):
+        # steps already posted are skipped when an event is redelivered
+        key = self.done_key(order_id)
+        pipe = self.client.pipeline()
+        pipe.hset(key, step, int(time.time()))
+        pipe.expire(key, 7 * 24 * 3600)
+        pipe.execute()
+
+    def run_once(self, order_id, step, fn, *args, **kwargs):
+        if self.is_done(order_id, step):
+            return
+        fn(*args, **kwargs)
+        self.set_done(order_id, step)
+
+    def create_group(self):
+        try:
+            self.client.execute_command('XGROUP', 'CREATE', self.stream,
+                                        self.group, '0', 'MKSTREAM')
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def start(self, handler):
+        self.handler = handler
+        thread = threading.Thread(target=self.listen,
+                                  name='order-events', daemon=True)
+        thread.start()
+        return thread
+
+    def listen(self):
+        while True:
+            try:
+                self.create_group()
+                # whatever this consumer got before a restart comes first
+                self.read('0')
+                while True:
+                    self.claim_stale()
+                    self.read('>')
+            except redis.ConnectionError:
+                logger.warning('Order events connection lost, reconnecting')
+                time.sleep(1)
+            except Exception:
+                logger.exception('Order events consumer failed')
+                time.sleep(1)
+
+    def read(self, last_id):
+        while True:
+            response = self.client.execute_command(
+                'XREADGROUP', 'GROUP', self.group, self.consumer,
+                'COUNT', self.batch_size, 'BLOCK', self.block,
+                'STREAMS', self.stream, last_id)
+            entries = response[0][1] if response else []
+            for message_id, fields in entries:
+                if fields:
+                    self.handle(message_id, fields)
+            # pending entries are read until there are none left, new ones
+            # a batch at a time
+            if last_id == '>' or not entries:
+                return
+            last_id = entries[-1][0]
+
+    def claim_stale(self):
+        pending = self.client.execute_command(
+            'XPENDING', self.stream, self.group, '-', '+', self.batch_size)
+        for message_id, consumer, idle, deliveries in pending or []:
+            if idle < self.claim_idle:
+                continue
+            claimed = self.client.execute_command(
+                'XCLAIM', self.stream, self.group, self.consumer,
+                self.claim_idle, message_id)
+            for claimed_id, fields in claimed or []:
+                if not fields:
+                    continue
+                if deliveries >= self.max_deliveries:
+                    self.move_to_dead_letter(claimed_id, decode_fields(fields),
+                                             'too many deliveries')
+                else:
+                    self.handle(claimed_id, fields)
+
+    def handle(self, message_id, fields):
+        fields = decode_fields(fields)
+        try:
+            event = json.loads(fields['event'])
+        except (KeyError, ValueError):
+            self.move_to_dead_letter(message_id, fields, 'malformed event')
+            return
+        try:
+            with connection():
+                self.handler(event)
+        except Exception:
+            # stays pending and gets claimed again after claim_idle
+            logger.exception('Order event %s failed', decode(message_id))
+            return
+        self.ack(message_id)
+
+    def ack(self, message_id):
+        self.client.execute_command('XACK', self.stream, self.group,
+                                    message_id)
+
+    def move_to_dead_letter(self, message_id, fields, reason):
+        logger.error('Order event %s moved to dead letters: %s',
+                     decode(message_id), reason)
+        self.client.lpush(self.dead_letter, json.dumps({
+            'id': decode(message_id), 'fields': fields, 'reason': reason}))
+        self.ack(message_id)
+
+
+order_events = OrderEventStream(session_client)
@@ -0,0 +1,29 @@
+import logging
+import os
+import socket
+
+from .helpers import session_client, jobs_key
+
+logger = logging.getLogger(__name__)
+
+
+def take_tick(key, interval):
+    # the key outlives the tick, so only one process runs per interval
+    owner = '{}-{}'.format(socket.gethostname(), os.getpid())
+    return bool(session_client.set(key, owner, nx=True,
+                                   px=int(interval * 900)))
+
+
+def schedule_exclusive(job_queue, name, callback, interval):
+    # every process schedules the job, one of them runs each tick
+    lock_key = jobs_key('{}_lock'.format(name))
+
+    def run(bot, job):
+        if not take_tick(lock_key, interval):
+            return
+        try:
+            callback(bot, job)
+        except Exception:
+            logger.exception('Job %s failed', name)
+
+    return job_queue.run_repeating(run, interval, first=interval, name=name)
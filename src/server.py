@@ -0,0 +1,93 @@
+import logging
+import threading
+
+from telegram.ext import ConversationHandler
+
+from .helpers import get_user_locale, user_sessions
+from .locales import translator
+from .models import connection
+from .notifications import KeyedExecutor
+
+logger = logging.getLogger(__name__)
+
+
+# check_update and handle_update pass the matched conversation through
+# instance attributes, keep them per thread when updates run in parallel
+class ThreadSafeConversationHandler(ConversationHandler):
+    def __init__(self, *args, **kwargs):
+        self.local = threading.local()
+        super().__init__(*args, **kwargs)
+
+    @property
+    def current_conversation(self):
+        return getattr(self.local, 'current_conversation', None)
+
+    @current_conversation.setter
+    def current_conversation(self, value):
+        self.local.current_conversation = value
+
+    @property
+    def current_handler(self):
+        return getattr(self.local, 'current_handler', None)
+
+    @current_handler.setter
+    def current_handler(self, value):
+        self.local.current_handler = value
+
+
+def get_update_key(update):
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        return 'user', user.id
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        return 'chat', chat.id
+    # nothing to keep in order with
+    return 'update', id(update)
+
+
+def get_update_locale(update):
+    user = getattr(update, 'effective_user', None)
+    if user is None:
+        return None
+    return get_user_locale(user.id)
+
+
+def install_update_pool(dispatcher, workers):
+    # updates of one user are handled in order, different users in parallel
+    executor = KeyedExecutor(workers)
+    process_update = dispatcher.process_update
+
+    def run_update(update):
+        with connection():
+            user_sessions.begin()
+            try:
+                # everything the update sends is in the language of its user
+                translator.set_locale(get_update_locale(update))
+                process_update(update)
+            finally:
+                translator.set_locale(None)
+                user_sessions.flush()
+
+    def submit_update(update):
+        executor.submit(get_update_key(update), run_update, update)
+
+    dispatcher.process_update = submit_update
+    return executor
+
+
+def start_updater(updater, config):
+    mode = config.get_server_mode()
+    if mode == 'webhook':
+        logger.info('Starting webhook on %s:%s',
+                    config.get_webhook_listen(), config.get_webhook_port())
+        updater.start_webhook(listen=config.get_webhook_listen(),
+                              port=config.get_webhook_port(),
+                              url_path=config.get_webhook_url_path(),
+                              cert=config.get_webhook_cert(),
+                              key=config.get_webhook_key(),
+                              webhook_url=config.get_webhook_url())
+    else:
+        if mode != 'polling':
+            logger.warning('Unknown server mode %s, using polling', mode)
+        updater.start_polling()
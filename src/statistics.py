@@ -0,0 +1,181 @@
+import datetime
+from collections import namedtuple
+from decimal import Decimal
+
+from peewee import fn, IntegrityError, JOIN
+
+from .models import Courier, DailySales, Location, Order, OrderItem, User, \
+    SOLD_STATUSES, db
+
+SalesStats = namedtuple('SalesStats', ['orders', 'revenue'])
+GroupSalesStats = namedtuple('GroupSalesStats',
+                             ['id', 'name', 'orders', 'revenue'])
+
+
+def orders_count():
+    return fn.COUNT(fn.DISTINCT(Order.id))
+
+
+def orders_revenue():
+    return fn.COALESCE(fn.SUM(OrderItem.count * OrderItem.total_price), 0)
+
+
+def to_decimal(value):
+    # sqlite hands back aggregates of decimal columns as floats
+    return Decimal(str(value or 0))
+
+
+def get_sales_stats(*expressions):
+    query = Order.select(orders_count(), orders_revenue()).join(
+        OrderItem, JOIN.LEFT_OUTER).where(Order.status << SOLD_STATUSES,
+                                          *expressions)
+    orders, revenue = query.scalar(as_tuple=True)
+    return SalesStats(orders or 0, to_decimal(revenue))
+
+
+def get_group_sales_stats(model, name_field, order_field):
+    # one row per entity, entities without confirmed orders included
+    query = (model
+             .select(model.id, name_field, orders_count(), orders_revenue())
+             .join(Order, JOIN.LEFT_OUTER,
+                   on=((order_field == model.id) &
+                       (Order.status << SOLD_STATUSES)))
+             .join(OrderItem, JOIN.LEFT_OUTER, on=(OrderItem.order == Order.id))
+             .group_by(model.id, name_field)
+             .order_by(model.id)
+             .tuples())
+    return [GroupSalesStats(entity_id, name, orders, to_decimal(revenue))
+            for entity_id, name, orders, revenue in query]
+
+
+def get_total_stats():
+    return get_sales_stats()
+
+
+def get_courier_stats():
+    return get_group_sales_stats(Courier, Courier.username, Order.courier)
+
+
+def get_location_stats():
+    return get_group_sales_stats(Location, Location.title, Order.location)
+
+
+def get_user_stats():
+    return get_group_sales_stats(User, User.username, Order.user)
+
+
+def get_daily_sales_stats(start, end):
+    query = DailySales.select(
+        fn.COALESCE(fn.SUM(DailySales.orders), 0),
+        fn.COALESCE(fn.SUM(DailySales.revenue), 0)
+    ).where(DailySales.date >= start, DailySales.date < end,
+            DailySales.product >> None)
+    orders, revenue = query.scalar(as_tuple=True)
+    return SalesStats(orders, to_decimal(revenue))
+
+
+def get_yearly_stats(today=None):
+    today = today or datetime.date.today()
+    start = today.replace(month=1, day=1)
+    return get_daily_sales_stats(start, start.replace(year=start.year + 1))
+
+
+def get_monthly_stats(today=None):
+    today = today or datetime.date.today()
+    start = today.replace(day=1)
+    if start.month == 12:
+        end = start.replace(year=start.year + 1, month=1)
+    else:
+        end = start.replace(month=start.month + 1)
+    return get_daily_sales_stats(start, end)
+
+
+def daily_sales_key(date, location_id, courier_id, product_id):
+    ids = ('' if value is None else str(value)
+           for value in (location_id, courier_id, product_id))
+    return '|'.join((str(date),) + tuple(ids))
+
+
+def increment_daily_sales(date, location_id, courier_id, product_id,
+                          orders, items, revenue):
+    key = daily_sales_key(date, location_id, courier_id, product_id)
+    update = DailySales.update(
+        orders=DailySales.orders + orders,
+        items=DailySales.items + items,
+        revenue=DailySales.revenue + revenue,
+    ).where(DailySales.key == key)
+    if update.execute():
+        return
+    try:
+        with db.atomic():
+            DailySales.create(key=key, date=date, location=location_id,
+                              courier=courier_id, product=product_id,
+                              orders=orders, items=items, revenue=revenue)
+    except IntegrityError:
+        # made by another confirmation in the meantime
+        update.execute()
+
+
+def add_order_to_daily_sales(order):
+    # called once when the order gets confirmed
+    date = order.date_created or datetime.date.today()
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+    location_id = order.location_id
+    courier_id = order.courier_id
+
+    total_items = 0
+    total_revenue = Decimal(0)
+    with db.atomic():
+        for item in order.order_items:
+            revenue = item.count * item.total_price
+            total_items += item.count
+            total_revenue += revenue
+            increment_daily_sales(date, location_id, courier_id,
+                                  item.product_id, 1, item.count, revenue)
+        increment_daily_sales(date, location_id, courier_id, None,
+                              1, total_items, total_revenue)
+
+
+def rebuild_daily_sales(batch_size=100):
+    day = fn.DATE(Order.date_created)
+    items = fn.COALESCE(fn.SUM(OrderItem.count), 0)
+    totals = (Order
+              .select(day, Order.location, Order.courier,
+                      orders_count(), items, orders_revenue())
+              .join(OrderItem, JOIN.LEFT_OUTER)
+              .where(Order.status << SOLD_STATUSES,
+                     ~(Order.date_created >> None))
+              .group_by(day, Order.location, Order.courier)
+              .tuples())
+    per_product = (Order
+                   .select(day, Order.location, Order.courier,
+                           OrderItem.product, orders_count(), items,
+                           orders_revenue())
+                   .join(OrderItem)
+                   .where(Order.status << SOLD_STATUSES,
+                          ~(Order.date_created >> None))
+                   .group_by(day, Order.location, Order.courier,
+                             OrderItem.product)
+                   .tuples())
+
+    rows = []
+    for date, location_id, courier_id, orders, count, revenue in totals:
+        rows.append(dict(key=daily_sales_key(date, location_id, courier_id,
+                                             None),
+                         date=date, location=location_id, courier=courier_id,
+                         product=None, orders=orders, items=count,
+                         revenue=to_decimal(revenue)))
+    for date, location_id, courier_id, product_id, orders, count, revenue \
+            in per_product:
+        rows.append(dict(key=daily_sales_key(date, location_id, courier_id,
+                                             product_id),
+                         date=date, location=location_id, courier=courier_id,
+                         product=product_id, orders=orders, items=count,
+                         revenue=to_decimal(revenue)))
+
+    with db.atomic():
+        DailySales.delete().execute()
+        for i in range(0, len(rows), batch_size):
+            DailySales.insert_many(rows[i:i + batch_size]).execute()
+    return len(rows)
@@ -0,0 +1,164 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from telegram import InputFile
+from telegram.error import RetryAfter
+from telegram.utils.request import Request
+
+logger = logging.getLogger(__name__)
+
+# lower goes first
+PRIORITY_PRIVATE = 0
+PRIORITY_CHANNEL = 1
+
+EDIT_METHODS = ('editMessageText', 'editMessageCaption',
+                'editMessageReplyMarkup')
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        # seconds until a token is available
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+def get_chat_priority(chat_id):
+    # private chats have positive ids, groups and channels negative ones or
+    # an @username
+    try:
+        return PRIORITY_PRIVATE if int(chat_id) > 0 else PRIORITY_CHANNEL
+    except (TypeError, ValueError):
+        return PRIORITY_CHANNEL
+
+
+# hands out send slots within the global and per group limits, waiting
+# customer replies are served before channel posts
+class SendScheduler:
+    def __init__(self, messages_per_second=30, group_messages_per_minute=20):
+        self.condition = threading.Condition()
+        self.bucket = TokenBucket(messages_per_second, messages_per_second)
+        self.group_rate = group_messages_per_minute / 60
+        self.group_capacity = group_messages_per_minute
+        # by last use, buckets idle long enough to be full again are dropped
+        self.group_buckets = OrderedDict()
+        self.waiting = [0, 0]
+        self.paused_until = 0
+        self.edits = {}
+
+    def get_group_bucket(self, chat_id, priority):
+        if priority == PRIORITY_PRIVATE:
+            return None
+        bucket = self.group_buckets.get(chat_id)
+        if bucket is None:
+            self.drop_idle_group_buckets(time.monotonic())
+            bucket = self.group_buckets[chat_id] = TokenBucket(
+                self.group_rate, self.group_capacity)
+        else:
+            self.group_buckets.move_to_end(chat_id)
+        return bucket
+
+    def drop_idle_group_buckets(self, now):
+        # a full bucket limits nothing a new one wouldn't
+        while self.group_buckets:
+            bucket = next(iter(self.group_buckets.values()))
+            bucket.refill(now)
+            if bucket.tokens < bucket.capacity:
+                break
+            self.group_buckets.popitem(last=False)
+
+    def get_delay(self, chat_id, priority):
+        now = time.monotonic()
+        if any(self.waiting[:priority]):
+            # something more urgent is queued, check again shortly
+            return 0.05
+        delay = max(self.paused_until - now, self.bucket.delay(now))
+        group_bucket = self.get_group_bucket(chat_id, priority)
+        if group_bucket is not None:
+            delay = max(delay, group_bucket.delay(now))
+        return delay
+
+    def acquire(self, chat_id, edit_key=None):
+        # False if a newer edit of the same message came in while waiting
+        priority = get_chat_priority(chat_id)
+        with self.condition:
+            if edit_key is not None:
+                ticket = self.edits[edit_key] = object()
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    # the newer edit may be sent and forgotten already
+                    if edit_key is not None \
+                            and self.edits.get(edit_key) is not ticket:
+                        return False
+                    delay = self.get_delay(chat_id, priority)
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                self.bucket.take()
+                group_bucket = self.get_group_bucket(chat_id, priority)
+                if group_bucket is not None:
+                    group_bucket.take()
+                if edit_key is not None:
+                    del self.edits[edit_key]
+                return True
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def pause(self, seconds):
+        with self.condition:
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + seconds)
+
+
+# telegram request that sends messages through the scheduler and waits out
+# flood limits instead of failing
+class ThrottledRequest(Request):
+    def __init__(self, scheduler, retries=3, **kwargs):
+        super().__init__(**kwargs)
+        self.scheduler = scheduler
+        self.retries = retries
+
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        if not method.startswith(('send', 'edit', 'forward')) \
+                or 'chat_id' not in data:
+            return super().post(url, data, timeout=timeout)
+
+        chat_id = data['chat_id']
+        edit_key = None
+        if method in EDIT_METHODS:
+            edit_key = method, chat_id, data.get('message_id')
+        # uploads are read from their files when sent, they can't go twice
+        retries = 0 if InputFile.is_inputfile(data) else self.retries
+        for attempt in range(retries + 1):
+            if not self.scheduler.acquire(chat_id, edit_key):
+                # a newer edit of this message replaces this one
+                return True
+            try:
+                # the request takes files out of the dict it is given
+                return super().post(url, dict(data), timeout=timeout)
+            except RetryAfter as e:
+                logger.warning('Flood limit on %s to %s, waiting %ss',
+                               method, chat_id, e.retry_after)
+                self.scheduler.pause(e.retry_after)
+                if attempt == retries:
+                    raise
@@ -0,0 +1,60 @@
+import threading
+
+import pytest
+
+pytest.importorskip('peewee')
+pytest.importorskip('redis')
+
+from src import helpers
+from src.helpers import ReadIndex
+
+
+class VersionStore:
+    def __init__(self):
+        self.version = 1
+
+    def get(self, key):
+        return str(self.version).encode('utf-8')
+
+    def incr(self, key):
+        self.version += 1
+        return self.version
+
+
+class SlowIndex(ReadIndex):
+    name = 'slow'
+    version_key = 'slow_version'
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+        self.loading = threading.Event()
+        self.proceed = threading.Event()
+
+    def load(self):
+        # what the database holds at the version the store is at
+        data = 'data {}'.format(self.store.version)
+        self.loading.set()
+        self.proceed.wait(5)
+        return data
+
+
+def test_invalidation_during_load_is_not_lost(monkeypatch):
+    store = VersionStore()
+    monkeypatch.setattr(helpers, 'session_client', store)
+    index = SlowIndex(store)
+
+    reader = threading.Thread(target=index.get_data)
+    reader.start()
+    assert index.loading.wait(5)
+
+    # another process changes the data while this one is loading
+    store.incr('slow_version')
+    invalidation = threading.Thread(target=index.invalidate,
+                                    args=(str(store.version),))
+    invalidation.start()
+    index.proceed.set()
+    reader.join(5)
+    invalidation.join(5)
+
+    assert index.get_data() == 'data 2'
@@ -0,0 +1,45 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('telegram')
+
+from src.throttle import SendScheduler
+
+
+def test_older_edit_of_a_message_gives_way():
+    scheduler = SendScheduler(messages_per_second=2)
+    # the next slots are a while away, both edits have to wait
+    assert scheduler.acquire(1)
+    assert scheduler.acquire(1)
+    edit_key = 'editMessageText', 123, 7
+    results = {}
+    errors = []
+
+    def edit(name):
+        try:
+            results[name] = scheduler.acquire(123, edit_key)
+        except Exception as e:
+            errors.append(e)
+
+    older = threading.Thread(target=edit, args=('older',))
+    newer = threading.Thread(target=edit, args=('newer',))
+    older.start()
+    time.sleep(0.05)
+    newer.start()
+    older.join(5)
+    newer.join(5)
+    assert not errors
+    assert results == {'older': False, 'newer': True}
+    assert edit_key not in scheduler.edits
+
+
+def test_idle_group_buckets_are_dropped():
+    scheduler = SendScheduler(group_messages_per_minute=60)
+    scheduler.acquire(-1)
+    assert -1 in scheduler.group_buckets
+    # a minute later the bucket of -1 is full again
+    scheduler.group_buckets[-1].updated -= 60
+    scheduler.acquire(-2)
+    assert list(scheduler.group_buckets) == [-2]